@@ -2,6 +2,11 @@
 into a single (mostly) standalone DLL or EXE. """
 
 import modulefinder
+import bisect
+import collections
+import functools
+import itertools
+import re
 import sys
 import os
 import marshal
@@ -10,8 +15,11 @@ import struct
 import io
 import sysconfig
 import zipfile
-import importlib
+import importlib.util
 import warnings
+import subprocess
+import shlex
+from concurrent.futures import ThreadPoolExecutor
 from importlib import machinery
 
 from . import pefile
@@ -32,6 +40,10 @@ _PKG_DIRECTORY = 5
 _C_BUILTIN = 6
 _PY_FROZEN = 7
 
+# Header written in front of the marshalled code of each .pyc file we add to
+# a Multifile: the magic number followed by zeroed flags and mtime fields.
+_PYC_HEADER = importlib.util.MAGIC_NUMBER + b'\0' * 8
+
 _PKG_NAMESPACE_DIRECTORY = object()
 
 # Check to see if we are running python_d, which implies we have a
@@ -50,6 +62,7 @@ startupModules = [
     'encodings', 'encodings.*', 'io', 'marshal', 'importlib.machinery',
     'importlib.util',
 ]
+_startupModulesSet = frozenset(startupModules)
 
 # These are some special init functions for some built-in Python modules that
 # deviate from the standard naming convention.  A value of None means that a
@@ -161,9 +174,120 @@ def lazycache(filename, module_globals):
     '_distutils_hack.override': '',
 }
 
+
+@functools.lru_cache(maxsize=None)
+def _compileOverride(source, filename, optimize):
+    """ Compiles the source of one of the above overrides.  These are the
+    same for every Freezer, so there is no sense in compiling them again
+    every time. """
+
+    return compile(source + '\n', filename, 'exec', optimize=optimize)
+
+
+# Stands in for the module name in the source of the stubs that we generate to
+# load extension modules.  It can't occur in a real module name.
+_stubModuleName = '<module name>'
+
+
+@functools.lru_cache(maxsize=None)
+def _compileStubTemplate(source, optimize):
+    return compile(source, _stubModuleName, 'exec', optimize=optimize)
+
+
+def _compileStub(source, moduleName, optimize):
+    """ Compiles the source of a stub module, in which _stubModuleName is
+    replaced with the given module name.  Since these stubs only differ by
+    the module name, which only appears in string constants, the source is
+    only compiled once, and the name is filled into a copy of the result. """
+
+    code = _compileStubTemplate(source, optimize)
+    consts = tuple(const.replace(_stubModuleName, moduleName)
+                   if type(const) is str else const
+                   for const in code.co_consts)
+    return code.replace(co_consts=consts, co_filename=moduleName)
+
 # These are missing modules that we've reported already this session.
 reportedMissing = {}
 
+_templateKeyRe = re.compile(r'%\((\w+)\)s')
+
+# The decimal representation of every byte value, used to write out the
+# frozen code as a C array literal without formatting each byte separately.
+_DEC = tuple(str(i) for i in range(256))
+
+
+@functools.lru_cache(maxsize=None)
+def _compileTemplate(template):
+    """ Turns a command template consisting of %(name)s substitutions into
+    a function that takes the mapping of values and returns the command,
+    so that the template only needs to be parsed once. """
+
+    pieces = _templateKeyRe.split(template)
+    if any('%' in literal for literal in pieces[::2]):
+        # Uses some other kind of format specifier; leave that to Python.
+        return lambda vars: template % vars
+
+    parts = []
+    for i, piece in enumerate(pieces):
+        if i % 2:
+            parts.append('str(vars[%r])' % (piece))
+        elif piece:
+            parts.append(repr(piece))
+
+    source = 'lambda vars: ' + (' + '.join(parts) or "''")
+    return eval(compile(source, '<command template>', 'eval'))
+
+
+def _runCommand(command):
+    """ Runs the given command line and returns its exit status.  Unlike
+    os.system, this doesn't start a shell to parse the command first. """
+
+    # On Windows, the command line is passed to the program as-is, whereas
+    # elsewhere it has to be split into arguments first.
+    if sys.platform != 'win32':
+        command = shlex.split(command)
+    try:
+        return subprocess.run(command).returncode
+    except OSError:
+        # The program couldn't be run, eg. because it doesn't exist.  Report
+        # this the same way the shell would.
+        return 127
+
+
+@functools.lru_cache(maxsize=None)
+def _probeMSVC():
+    """ Returns the VC directory of a Microsoft Visual Studio installation in
+    one of the standard locations, or None if there is none.  The result is
+    cached, since the disk is probed again for every CompilationEnvironment
+    otherwise. """
+
+    for dir in ('/c/Program Files/Microsoft Visual Studio 9.0/VC',
+                '/c/Program Files (x86)/Microsoft Visual Studio 9.0/VC',
+                '/c/Program Files/Microsoft Visual Studio .NET 2003/Vc7'):
+        fn = Filename(dir)
+        if fn.exists():
+            return fn.toOsSpecific()
+
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def _probePSDK(msvc):
+    """ Returns the directory of the Windows Platform SDK that goes with the
+    given MSVC directory, or None if it could not be found.  Cached, like
+    _probeMSVC(). """
+
+    if platform.architecture()[0] == '32bit':
+        fn = Filename('/c/Program Files/Microsoft Platform SDK for Windows Server 2003 R2')
+        if fn.exists():
+            return fn.toOsSpecific()
+
+    dir = os.path.join(msvc, 'PlatformSDK')
+    if os.path.exists(dir):
+        return dir
+
+    return None
+
 
 class CompilationEnvironment:
     """ Create an instance of this class to record the commands to
@@ -171,6 +295,12 @@ class CompilationEnvironment:
     can create a custom instance of this class (or simply set the
     compile strings directly) to customize the build environment. """
 
+    __slots__ = (
+        'platform', 'compileObj', 'compileObjExe', 'compileObjDll',
+        'linkExe', 'linkDll', 'Python', 'PythonIPath', 'PythonVersion',
+        'MSVC', 'PSDK', 'MD', 'suffix64', 'dllext', 'arch',
+    )
+
     def __init__(self, platform):
         self.platform = platform
 
@@ -213,27 +343,15 @@ class CompilationEnvironment:
 
     def determineStandardSetup(self):
         if self.platform.startswith('win'):
-            self.Python = sysconf.PREFIX
-
-            if 'VCINSTALLDIR' in os.environ:
-                self.MSVC = os.environ['VCINSTALLDIR']
-            elif Filename('/c/Program Files/Microsoft Visual Studio 9.0/VC').exists():
-                self.MSVC = Filename('/c/Program Files/Microsoft Visual Studio 9.0/VC').toOsSpecific()
-            elif Filename('/c/Program Files (x86)/Microsoft Visual Studio 9.0/VC').exists():
-                self.MSVC = Filename('/c/Program Files (x86)/Microsoft Visual Studio 9.0/VC').toOsSpecific()
-            elif Filename('/c/Program Files/Microsoft Visual Studio .NET 2003/Vc7').exists():
-                self.MSVC = Filename('/c/Program Files/Microsoft Visual Studio .NET 2003/Vc7').toOsSpecific()
-            else:
+            self.Python = sysconfig.get_config_var('prefix')
+
+            self.MSVC = os.environ.get('VCINSTALLDIR') or _probeMSVC()
+            if not self.MSVC:
                 print('Could not locate Microsoft Visual C++ Compiler! Try running from the Visual Studio Command Prompt.')
                 sys.exit(1)
 
-            if 'WindowsSdkDir' in os.environ:
-                self.PSDK = os.environ['WindowsSdkDir']
-            elif platform.architecture()[0] == '32bit' and Filename('/c/Program Files/Microsoft Platform SDK for Windows Server 2003 R2').exists():
-                self.PSDK = Filename('/c/Program Files/Microsoft Platform SDK for Windows Server 2003 R2').toOsSpecific()
-            elif os.path.exists(os.path.join(self.MSVC, 'PlatformSDK')):
-                self.PSDK = os.path.join(self.MSVC, 'PlatformSDK')
-            else:
+            self.PSDK = os.environ.get('WindowsSdkDir') or _probePSDK(self.MSVC)
+            if not self.PSDK:
                 print('Could not locate the Microsoft Windows Platform SDK! Try running from the Visual Studio Command Prompt.')
                 sys.exit(1)
 
@@ -255,7 +373,10 @@ class CompilationEnvironment:
                 self.linkExe = 'link /nologo /MAP:NUL /FIXED:NO /OPT:REF /STACK:4194304 /INCREMENTAL:NO /LIBPATH:"%(python)s\\libs"  /out:%(basename)s.exe %(basename)s.obj'
                 self.linkDll = 'link /nologo /DLL /MAP:NUL /FIXED:NO /OPT:REF /INCREMENTAL:NO /LIBPATH:"%(python)s\\libs"  /out:%(basename)s%(dllext)s.pyd %(basename)s.obj'
             else:
-                os.environ['PATH'] += ';' + self.MSVC + '\\bin' + self.suffix64 + ';' + self.MSVC + '\\Common7\\IDE;' + self.PSDK + '\\bin'
+                # Don't add these again if another environment already did.
+                extraPath = self.MSVC + '\\bin' + self.suffix64 + ';' + self.MSVC + '\\Common7\\IDE;' + self.PSDK + '\\bin'
+                if extraPath not in os.environ['PATH']:
+                    os.environ['PATH'] += ';' + extraPath
 
                 self.compileObjExe = 'cl /wd4996 /Fo%(basename)s.obj /nologo /c %(MD)s /Zi /O2 /Ob2 /EHsc /Zm300 /W3 /I"%(pythonIPath)s" /I"%(PSDK)s\\include" /I"%(MSVC)s\\include" %(filename)s'
                 self.compileObjDll = self.compileObjExe
@@ -285,7 +406,7 @@ class CompilationEnvironment:
 
         else:
             # Unix
-            lib_dir = sysconf.get_python_lib(plat_specific=1, standard_lib=1)
+            lib_dir = sysconfig.get_path('platstdlib')
             #python_a = os.path.join(lib_dir, "config", "libpython%(pythonVersion)s.a")
             self.compileObjExe = "%(CC)s %(CFLAGS)s -c -o %(basename)s.o -pthread -O2 %(filename)s -I%(pythonIPath)s"
             self.compileObjDll = "%(CC)s %(CFLAGS)s %(CCSHARED)s -c -o %(basename)s.o -O2 %(filename)s -I%(pythonIPath)s"
@@ -296,8 +417,12 @@ class CompilationEnvironment:
                 self.linkExe += " -L/usr/PCBSD/local/lib"
                 self.linkDll += " -L/usr/PCBSD/local/lib"
 
-    def compileExe(self, filename, basename, extraLink=[]):
-        compile = self.compileObjExe % dict({
+    def _getFormatVars(self, filename, basename):
+        """ Returns the mapping used to fill in the compile and link
+        commands.  The config vars are layered on top rather than copied into
+        a new dict, since there are several hundred of them. """
+
+        return collections.ChainMap(sysconfig.get_config_vars(), {
             'python': self.Python,
             'MSVC': self.MSVC,
             'PSDK': self.PSDK,
@@ -308,59 +433,35 @@ class CompilationEnvironment:
             'arch': self.arch,
             'filename': filename,
             'basename': basename,
-        }, **sysconf.get_config_vars())
+            'dllext': self.dllext,
+        })
+
+    def compileExe(self, filename, basename, extraLink=[]):
+        vars = self._getFormatVars(filename, basename)
+
+        compile = _compileTemplate(self.compileObjExe)(vars)
         sys.stderr.write(compile + '\n')
-        if os.system(compile) != 0:
+        if _runCommand(compile) != 0:
             raise Exception('failed to compile %s.' % basename)
 
-        link = self.linkExe % dict({
-            'python': self.Python,
-            'MSVC': self.MSVC,
-            'PSDK': self.PSDK,
-            'suffix64': self.suffix64,
-            'pythonIPath': self.PythonIPath,
-            'pythonVersion': self.PythonVersion,
-            'arch': self.arch,
-            'filename': filename,
-            'basename': basename,
-        }, **sysconf.get_config_vars())
+        link = _compileTemplate(self.linkExe)(vars)
         link += ' ' + ' '.join(extraLink)
         sys.stderr.write(link + '\n')
-        if os.system(link) != 0:
+        if _runCommand(link) != 0:
             raise Exception('failed to link %s.' % basename)
 
     def compileDll(self, filename, basename, extraLink=[]):
-        compile = self.compileObjDll % dict({
-            'python': self.Python,
-            'MSVC': self.MSVC,
-            'PSDK': self.PSDK,
-            'suffix64': self.suffix64,
-            'MD': self.MD,
-            'pythonIPath': self.PythonIPath,
-            'pythonVersion': self.PythonVersion,
-            'arch': self.arch,
-            'filename': filename,
-            'basename': basename,
-        }, **sysconf.get_config_vars())
+        vars = self._getFormatVars(filename, basename)
+
+        compile = _compileTemplate(self.compileObjDll)(vars)
         sys.stderr.write(compile + '\n')
-        if os.system(compile) != 0:
+        if _runCommand(compile) != 0:
             raise Exception('failed to compile %s.' % basename)
 
-        link = self.linkDll % dict({
-            'python': self.Python,
-            'MSVC': self.MSVC,
-            'PSDK': self.PSDK,
-            'suffix64': self.suffix64,
-            'pythonIPath': self.PythonIPath,
-            'pythonVersion': self.PythonVersion,
-            'arch': self.arch,
-            'filename': filename,
-            'basename': basename,
-            'dllext': self.dllext,
-        }, **sysconf.get_config_vars())
+        link = _compileTemplate(self.linkDll)(vars)
         link += ' ' + ' '.join(extraLink)
         sys.stderr.write(link + '\n')
-        if os.system(link) != 0:
+        if _runCommand(link) != 0:
             raise Exception('failed to link %s.' % basename)
 
 
@@ -704,21 +805,59 @@ okMissing = [
     'collections.Iterable', 'collections.Mapping', 'collections.MutableMapping',
     'collections.Sequence', 'numpy_distutils', '_winapi',
 ]
+_okMissingSet = frozenset(okMissing)
+
+# Layouts of the headers of universal (fat) macOS binaries and PE files, as
+# far as we need to read them.
+_fat_header_struct = struct.Struct('>I')
+_fat_arch_struct = struct.Struct('>IIIII')
+_fat_arch_64_struct = struct.Struct('>QQQQQ')
+_pe_offset_struct = struct.Struct('<I')
+_pe_magic_struct = struct.Struct('<H')
+
+# Layouts of the ELF file header (after e_ident), section header and symbol
+# table entry, indexed by endianness and whether it is a 64-bit file.
+_elf_structs = {}
+for _endian in '<>':
+    _elf_structs[_endian, 0] = (
+        struct.Struct(_endian + 'HHIIIIIHHHHHH'),
+        struct.Struct(_endian + '4xI4xIIII8xI'),
+        struct.Struct(_endian + 'IIIBBH'),
+    )
+    _elf_structs[_endian, 1] = (
+        struct.Struct(_endian + 'HHIQQQIHHHHHH'),
+        struct.Struct(_endian + '4xI8xQQQI12xQ'),
+        struct.Struct(_endian + 'IBBHQQ'),
+    )
+del _endian
+
+# Layouts used to look up a symbol in a Mach-O file of either endianness: the
+# header (after the magic number), load command header, segment, 64-bit
+# segment and symbol table commands (after the load command header), and the
+# 32-bit and 64-bit symbol table entries.
+_macho_structs = {
+    endian: tuple(struct.Struct(endian + layout) for layout in (
+        'IIIIII', 'II', '16sIIIIIIII', '16sQQQQIIII', 'IIII', 'IBBHI', 'IBBHQ'))
+    for endian in '<>'
+}
 
 # Since around macOS 10.15, Apple's codesigning process has become more strict.
 # Appending data to the end of a Mach-O binary is now explicitly forbidden. The
 # solution is to embed our own segment into the binary so it can be properly
 # signed.
 mach_header_64_layout = '<IIIIIIII'
+_mach_header_64_struct = struct.Struct(mach_header_64_layout)
 
 # Each load command is guaranteed to start with the command identifier and
 # command size. We'll call this the "lc header".
 lc_header_layout = '<II'
+_lc_header_struct = struct.Struct(lc_header_layout)
 
 # Each Mach-O segment is made up of sections. We need to change both the segment
 # and section information, so we'll need to know the layout of a section as
 # well.
 section64_header_layout = '<16s16sQQIIIIIIII'
+_section64_header_struct = struct.Struct(section64_header_layout)
 
 # These are all of the load commands we'll need to modify parts of.
 LC_SEGMENT_64 = 0x19
@@ -737,6 +876,9 @@ lc_layouts = {
     LC_DATA_IN_CODE: '<IIII',
 }
 
+# The above layouts, precompiled, since they are used in loops.
+_lc_structs = {cmd: struct.Struct(layout) for cmd, layout in lc_layouts.items()}
+
 # All of our modifications involve sliding some offsets, since we need to insert
 # our data in the middle of the binary (we can't just put the data at the end
 # since __LINKEDIT must be the last segment).
@@ -751,15 +893,98 @@ lc_indices_to_slide = {
 }
 
 
+@functools.lru_cache(maxsize=None)
+def _build_suffixes(platform):
+    """ Returns the (suffix, mode, type) tuples of the files that the module
+    finder should recognize as modules when freezing for the given platform.
+    This only depends on the platform, so it is computed once for each. """
+
+    if platform == PandaSystem.getPlatform():
+        suffixes = (
+            [(s, 'rb', _C_EXTENSION) for s in machinery.EXTENSION_SUFFIXES] +
+            [(s, 'rb', _PY_SOURCE) for s in machinery.SOURCE_SUFFIXES] +
+            [(s, 'rb', _PY_COMPILED) for s in machinery.BYTECODE_SUFFIXES]
+        )
+    else:
+        suffixes = [('.py', 'rb', 1), ('.pyc', 'rb', 2)]
+
+        abi_version = '{0}{1}'.format(*sys.version_info)
+        abi_flags = ''
+        if sys.version_info < (3, 8):
+            abi_flags += 'm'
+
+        if 'android' in platform:
+            arch = platform.split('_', 1)[1]
+            if arch in ('arm64', 'aarch64'):
+                suffixes.append(('.cpython-{0}{1}-aarch64-linux-android.so'.format(abi_version, abi_flags), 'rb', 3))
+            elif arch in ('arm', 'armv7l'):
+                suffixes.append(('.cpython-{0}{1}-arm-linux-androideabi.so'.format(abi_version, abi_flags), 'rb', 3))
+            elif arch in ('x86_64', 'amd64'):
+                suffixes.append(('.cpython-{0}{1}-x86_64-linux-android.so'.format(abi_version, abi_flags), 'rb', 3))
+            elif arch in ('i386', 'i686'):
+                suffixes.append(('.cpython-{0}{1}-i686-linux-android.so'.format(abi_version, abi_flags), 'rb', 3))
+
+            suffixes += [
+                ('.abi{0}.so'.format(sys.version_info[0]), 'rb', 3),
+                ('.so', 'rb', 3),
+            ]
+        elif 'linux' in platform:
+            suffixes += [
+                ('.cpython-{0}{1}-x86_64-linux-gnu.so'.format(abi_version, abi_flags), 'rb', 3),
+                ('.cpython-{0}{1}-i686-linux-gnu.so'.format(abi_version, abi_flags), 'rb', 3),
+                ('.abi{0}.so'.format(sys.version_info[0]), 'rb', 3),
+                ('.so', 'rb', 3),
+            ]
+        elif 'win' in platform:
+            # ABI flags are not appended on Windows.
+            suffixes += [
+                ('.cp{0}-win_amd64.pyd'.format(abi_version), 'rb', 3),
+                ('.cp{0}-win32.pyd'.format(abi_version), 'rb', 3),
+                ('.pyd', 'rb', 3),
+            ]
+        elif 'mac' in platform:
+            suffixes += [
+                ('.cpython-{0}{1}-darwin.so'.format(abi_version, abi_flags), 'rb', 3),
+                ('.abi{0}.so'.format(sys.version_info[0]), 'rb', 3),
+                ('.so', 'rb', 3),
+            ]
+        else: # FreeBSD et al.
+            suffixes += [
+                ('.cpython-{0}{1}.so'.format(abi_version, abi_flags), 'rb', 3),
+                ('.abi{0}.so'.format(sys.version_info[0]), 'rb', 3),
+                ('.so', 'rb', 3),
+            ]
+
+    return tuple(suffixes)
+
+
+def _addPackagePath(packageName, path):
+    """ Like modulefinder.AddPackagePath, but does nothing if the path has
+    already been registered for that package.  The registry is global, and
+    the finder adds every registered path to the package's __path__, so
+    duplicates would otherwise pile up with every Freezer that is created
+    and be searched over and over again. """
+
+    paths = modulefinder.packagePathMap.setdefault(packageName, [])
+    if path not in paths:
+        paths.append(path)
+
+
 class Freezer:
     class ModuleDef:
+        __slots__ = (
+            'moduleName', 'filename', 'implicit', 'guess', 'exclude',
+            'forbid', 'allowChildren', 'fromSource', 'text',
+        )
+
         def __init__(self, moduleName, filename = None,
                      implicit = False, guess = False,
                      exclude = False, forbid = False,
                      allowChildren = False, fromSource = None,
                      text = None):
-            # The Python module name.
-            self.moduleName = moduleName
+            # The Python module name.  There are a lot of these, and they
+            # are used as keys all over the place, so intern them.
+            self.moduleName = sys.intern(moduleName)
 
             # The file on disk it was loaded from, if any.
             self.filename = filename
@@ -804,18 +1029,20 @@ class Freezer:
                 self.allowChildren = False
 
         def __repr__(self):
-            args = [repr(self.moduleName), repr(self.filename)]
+            # The flags may still change after construction (eg. guess is
+            # cleared by done()), so this can't be computed up front.
+            args = f'{self.moduleName!r}, {self.filename!r}'
             if self.implicit:
-                args.append('implicit = True')
+                args += ', implicit = True'
             if self.guess:
-                args.append('guess = True')
+                args += ', guess = True'
             if self.exclude:
-                args.append('exclude = True')
+                args += ', exclude = True'
             if self.forbid:
-                args.append('forbid = True')
+                args += ', forbid = True'
             if self.allowChildren:
-                args.append('allowChildren = True')
-            return 'ModuleDef(%s)' % (', '.join(args))
+                args += ', allowChildren = True'
+            return f'ModuleDef({args})'
 
     def __init__(self, previous = None, debugLevel = 0,
                  platform = None, path=None, hiddenImports=None, optimize=None):
@@ -875,9 +1102,24 @@ class Freezer:
         self.previousModules = {}
         self.modules = {}
 
+        # Caches for getModulePath() and getModuleStar(), and the search path
+        # that they were filled from, see __checkModuleCaches().
+        self._modulePaths = {}
+        self._moduleStars = {}
+        self._moduleCachePath = None
+
+        # Code objects that have been marshalled, by id, along with the
+        # result, and the code objects that came out of __replacePaths().
+        self._marshalledCode = {}
+        self._replacedCode = {}
+
+        # The streams added to a Multifile by addToMultifile(), which need to
+        # be kept alive until it has been flushed.
+        self.__multifileStreams = []
+
         if previous:
-            self.previousModules = dict(previous.modules)
-            self.modules = dict(previous.modules)
+            self.previousModules = previous.modules.copy()
+            self.modules = previous.modules.copy()
 
         # Exclude doctest by default; it is not very useful in production
         # builds.  It can be explicitly included if desired.
@@ -890,7 +1132,7 @@ class Freezer:
             if module and getattr(module, '__path__', None) is not None:
                 modPath = list(getattr(module, '__path__'))
                 if modPath:
-                    modulefinder.AddPackagePath(moduleName, modPath[0])
+                    _addPackagePath(moduleName, modPath[0])
 
         # Module with non-obvious dependencies
         self.hiddenImports = defaultHiddenImports.copy()
@@ -909,64 +1151,13 @@ class Freezer:
             plyer_platform = 'win'
 
         if plyer_platform:
-            self.hiddenImports['plyer'].append(f'plyer.platforms.{plyer_platform}.*')
+            # Don't append to the list in place; it is shared with
+            # defaultHiddenImports, and would keep growing with every Freezer
+            # that is constructed in this session.
+            self.hiddenImports['plyer'] = self.hiddenImports['plyer'] + [f'plyer.platforms.{plyer_platform}.*']
 
         # Suffix/extension for Python C extension modules
-        if self.platform == PandaSystem.getPlatform():
-            suffixes = (
-                [(s, 'rb', _C_EXTENSION) for s in machinery.EXTENSION_SUFFIXES] +
-                [(s, 'rb', _PY_SOURCE) for s in machinery.SOURCE_SUFFIXES] +
-                [(s, 'rb', _PY_COMPILED) for s in machinery.BYTECODE_SUFFIXES]
-            )
-        else:
-            suffixes = [('.py', 'rb', 1), ('.pyc', 'rb', 2)]
-
-            abi_version = '{0}{1}'.format(*sys.version_info)
-            abi_flags = ''
-            if sys.version_info < (3, 8):
-                abi_flags += 'm'
-
-            if 'android' in self.platform:
-                arch = self.platform.split('_', 1)[1]
-                if arch in ('arm64', 'aarch64'):
-                    suffixes.append(('.cpython-{0}{1}-aarch64-linux-android.so'.format(abi_version, abi_flags), 'rb', 3))
-                elif arch in ('arm', 'armv7l'):
-                    suffixes.append(('.cpython-{0}{1}-arm-linux-androideabi.so'.format(abi_version, abi_flags), 'rb', 3))
-                elif arch in ('x86_64', 'amd64'):
-                    suffixes.append(('.cpython-{0}{1}-x86_64-linux-android.so'.format(abi_version, abi_flags), 'rb', 3))
-                elif arch in ('i386', 'i686'):
-                    suffixes.append(('.cpython-{0}{1}-i686-linux-android.so'.format(abi_version, abi_flags), 'rb', 3))
-
-                suffixes += [
-                    ('.abi{0}.so'.format(sys.version_info[0]), 'rb', 3),
-                    ('.so', 'rb', 3),
-                ]
-            elif 'linux' in self.platform:
-                suffixes += [
-                    ('.cpython-{0}{1}-x86_64-linux-gnu.so'.format(abi_version, abi_flags), 'rb', 3),
-                    ('.cpython-{0}{1}-i686-linux-gnu.so'.format(abi_version, abi_flags), 'rb', 3),
-                    ('.abi{0}.so'.format(sys.version_info[0]), 'rb', 3),
-                    ('.so', 'rb', 3),
-                ]
-            elif 'win' in self.platform:
-                # ABI flags are not appended on Windows.
-                suffixes += [
-                    ('.cp{0}-win_amd64.pyd'.format(abi_version), 'rb', 3),
-                    ('.cp{0}-win32.pyd'.format(abi_version), 'rb', 3),
-                    ('.pyd', 'rb', 3),
-                ]
-            elif 'mac' in self.platform:
-                suffixes += [
-                    ('.cpython-{0}{1}-darwin.so'.format(abi_version, abi_flags), 'rb', 3),
-                    ('.abi{0}.so'.format(sys.version_info[0]), 'rb', 3),
-                    ('.so', 'rb', 3),
-                ]
-            else: # FreeBSD et al.
-                suffixes += [
-                    ('.cpython-{0}{1}.so'.format(abi_version, abi_flags), 'rb', 3),
-                    ('.abi{0}.so'.format(sys.version_info[0]), 'rb', 3),
-                    ('.so', 'rb', 3),
-                ]
+        suffixes = list(_build_suffixes(self.platform))
 
         if optimize is None or optimize < 0:
             self.optimize = sys.flags.optimize
@@ -983,9 +1174,8 @@ class Freezer:
         constructor, but it may be called at any point during
         processing. """
 
-        for key, value in list(freezer.modules.items()):
-            self.previousModules[key] = value
-            self.modules[key] = value
+        self.previousModules.update(freezer.modules)
+        self.modules.update(freezer.modules)
 
     def excludeModule(self, moduleName, forbid = False, allowChildren = False,
                       fromSource = None):
@@ -1006,12 +1196,19 @@ class Freezer:
         imported at runtime in order to determine the true value of
         __path__. """
 
-        str = 'import %s' % (moduleName)
-        exec(str)
-
-        module = sys.modules[moduleName]
+        module = importlib.import_module(moduleName)
         for path in module.__path__:
-            modulefinder.AddPackagePath(moduleName, path)
+            _addPackagePath(moduleName, path)
+
+    def __checkModuleCaches(self):
+        """ Clears the caches used by getModulePath() and getModuleStar() if
+        the search path has changed since they were filled. """
+
+        path = self.mf.path
+        if path != self._moduleCachePath:
+            self._moduleCachePath = list(path)
+            self._modulePaths.clear()
+            self._moduleStars.clear()
 
     def getModulePath(self, moduleName):
         """ Looks for the indicated directory module and returns the
@@ -1019,43 +1216,58 @@ class Freezer:
         files can be found.  If the module is a .py file and not a
         directory, returns None. """
 
+        self.__checkModuleCaches()
+        if moduleName in self._modulePaths:
+            path = self._modulePaths[moduleName]
+            return list(path) if path is not None else None
+
         path = None
         baseName = moduleName
         if '.' in baseName:
-            parentName, baseName = moduleName.rsplit('.', 1)
+            parentName, _, baseName = moduleName.rpartition('.')
             path = self.getModulePath(parentName)
             if path is None:
+                self._modulePaths[moduleName] = None
                 return None
 
         try:
             file, pathname, description = self.mf.find_module(baseName, path)
         except ImportError:
-            return None
+            pathname = None
 
-        if not self.mf._dir_exists(pathname):
+        if pathname is None or not self.mf._dir_exists(pathname):
+            self._modulePaths[moduleName] = None
             return None
 
+        self._modulePaths[moduleName] = (pathname,)
         return [pathname]
 
     def getModuleStar(self, moduleName):
         """ Looks for the indicated directory module and returns the
         __all__ member: the list of symbols within the module. """
 
+        self.__checkModuleCaches()
+        if moduleName in self._moduleStars:
+            modules = self._moduleStars[moduleName]
+            return list(modules) if modules is not None else None
+
         # Open the directory and scan for *.py files.
         path = None
         baseName = moduleName
         if '.' in baseName:
-            parentName, baseName = moduleName.rsplit('.', 1)
+            parentName, _, baseName = moduleName.rpartition('.')
             path = self.getModulePath(parentName)
             if path is None:
+                self._moduleStars[moduleName] = None
                 return None
 
         try:
             file, pathname, description = self.mf.find_module(baseName, path)
         except ImportError:
-            return None
+            pathname = None
 
-        if not self.mf._dir_exists(pathname):
+        if pathname is None or not self.mf._dir_exists(pathname):
+            self._moduleStars[moduleName] = None
             return None
 
         # Scan the directory, looking for .py files.
@@ -1064,6 +1276,7 @@ class Freezer:
             if basename.endswith('.py') and basename != '__init__.py':
                 modules.append(basename[:-3])
 
+        self._moduleStars[moduleName] = tuple(modules)
         return modules
 
     def _gatherSubmodules(self, moduleName, implicit = False, newName = None,
@@ -1071,6 +1284,7 @@ class Freezer:
                           text = None):
         if not newName:
             newName = moduleName
+        newName = sys.intern(newName)
 
         assert moduleName.endswith('.*')
         assert newName.endswith('.*')
@@ -1094,7 +1308,16 @@ class Freezer:
             modulePath = self.getModulePath(topName)
             if modulePath:
                 for dirname in modulePath:
-                    for basename in sorted(self.mf._listdir(dirname)):
+                    entries = self.mf._scan_dir(dirname)
+                    if isinstance(entries, dict):
+                        # Plain directory; we can tell the subdirectories
+                        # apart without looking inside every file.
+                        basenames = sorted(name for name, entry in entries.items()
+                                           if entry.is_dir())
+                    else:
+                        basenames = sorted(self.mf._listdir(dirname))
+
+                    for basename in basenames:
                         if self.mf._file_exists(os.path.join(dirname, basename, '__init__.py')):
                             parentName = '%s.%s' % (topName, basename)
                             newParentName = '%s.%s' % (newTopName, basename)
@@ -1184,12 +1407,14 @@ class Freezer:
         includes = []
         autoIncludes = []
         origToNewName = {}
-        for newName, mdef in sorted(self.modules.items()):
+        modules = self.modules
+        for newName in sorted(modules):
+            mdef = modules[newName]
             moduleName = mdef.moduleName
             origToNewName[moduleName] = newName
             if mdef.implicit and '.' in newName:
                 # For implicit modules, check if the parent is excluded.
-                parentName, baseName = newName.rsplit('.', 1)
+                parentName, _, baseName = newName.rpartition('.')
                 if parentName in excludeDict:
                     mdef = excludeDict[parentName]
 
@@ -1201,9 +1426,11 @@ class Freezer:
             else:
                 includes.append(mdef)
 
-        # Add the excludes to the ModuleFinder.
-        for exclude in excludeDict:
-            self.mf.excludes.append(exclude)
+        # Add the excludes to the ModuleFinder.  This may change what the
+        # module paths resolve to.
+        self.mf.excludes.update(excludeDict)
+        self._modulePaths.clear()
+        self._moduleStars.clear()
 
         # Attempt to import the explicit modules into the modulefinder.
 
@@ -1214,6 +1441,10 @@ class Freezer:
         # statements.
         includes.sort(key = self.__sortModuleKey)
 
+        # Most of these will be looked up on the search path, so list the
+        # directories on it up front.
+        self.mf._scan_dirs(self.mf.path)
+
         # Now walk through the list and import them all.
         for mdef in includes:
             try:
@@ -1236,62 +1467,81 @@ class Freezer:
                 # module.
                 pass
 
-        # Check if any new modules we found have "hidden" imports
-        for origName in list(self.mf.modules.keys()):
-            hidden = self.hiddenImports.get(origName, [])
-            for modname in hidden:
+        # Now make a single pass over everything the modulefinder found.
+        # Each module has its "hidden" imports loaded and is added to the
+        # export list if it wasn't already in there.  Loading a module may
+        # bring in more modules, which are picked up by the same pass, since
+        # the modulefinder's dict only grows and preserves insertion order.
+        missing = []
+        mfModules = self.mf.modules
+        loadModule = self.__loadModule
+        ModuleDef = self.ModuleDef
+        getHidden = self.hiddenImports.get
+        origNames = list(mfModules)
+        loadedHidden = set()
+        i = 0
+        while i < len(origNames):
+            origName = origNames[i]
+            i += 1
+
+            if origName not in origToNewName:
+                modules[origName] = ModuleDef(origName, implicit = True)
+
+            for modname in getHidden(origName, ()):
+                # Several modules may share a hidden import; there's no need
+                # to go through it again, which is costly for wildcards.
+                if modname in loadedHidden:
+                    continue
+                loadedHidden.add(modname)
+
                 if modname.endswith('.*'):
                     mdefs = self._gatherSubmodules(modname, implicit = True)
                     for mdef in mdefs.values():
                         try:
-                            self.__loadModule(mdef)
+                            loadModule(mdef)
                         except ImportError:
                             pass
                 else:
                     try:
-                        self.__loadModule(self.ModuleDef(modname, implicit = True))
+                        loadModule(ModuleDef(modname, implicit = True))
                     except ImportError:
                         pass
 
-        # Special case for sysconfig, which depends on a platform-specific
-        # sysconfigdata module on POSIX systems.
-        missing = []
-        if 'sysconfig' in self.mf.modules and \
-           ('linux' in self.platform or 'mac' in self.platform or 'emscripten' in self.platform):
-            modname = '_sysconfigdata'
-            if sys.version_info >= (3, 6):
-                modname += '_'
-                if sys.version_info < (3, 8):
-                    modname += 'm'
-
-                if 'linux' in self.platform:
-                    arch = self.platform.split('_', 1)[1]
-                    modname += '_linux_' + arch + '-linux-gnu'
-                elif 'mac' in self.platform:
-                    modname += '_darwin_darwin'
-                elif 'emscripten' in self.platform:
-                    if '_' in self.platform:
+            # Special case for sysconfig, which depends on a platform-specific
+            # sysconfigdata module on POSIX systems.
+            if origName == 'sysconfig' and \
+               ('linux' in self.platform or 'mac' in self.platform or 'emscripten' in self.platform):
+                modname = '_sysconfigdata'
+                if sys.version_info >= (3, 6):
+                    modname += '_'
+                    if sys.version_info < (3, 8):
+                        modname += 'm'
+
+                    if 'linux' in self.platform:
                         arch = self.platform.split('_', 1)[1]
-                    else:
-                        arch = 'wasm32'
-                    modname += '_emscripten_' + arch + '-emscripten'
+                        modname += '_linux_' + arch + '-linux-gnu'
+                    elif 'mac' in self.platform:
+                        modname += '_darwin_darwin'
+                    elif 'emscripten' in self.platform:
+                        if '_' in self.platform:
+                            arch = self.platform.split('_', 1)[1]
+                        else:
+                            arch = 'wasm32'
+                        modname += '_emscripten_' + arch + '-emscripten'
 
-            try:
-                self.__loadModule(self.ModuleDef(modname, implicit=True))
-            except Exception:
-                missing.append(modname)
+                try:
+                    loadModule(ModuleDef(modname, implicit=True))
+                except Exception:
+                    missing.append(modname)
 
-        # Now, any new modules we found get added to the export list.
-        for origName in list(self.mf.modules.keys()):
-            if origName not in origToNewName:
-                self.modules[origName] = self.ModuleDef(origName, implicit = True)
+            if len(mfModules) > len(origNames):
+                origNames.extend(itertools.islice(mfModules, len(origNames), None))
 
+        # Names that are already accounted for.  The names we add to
+        # self.modules below are all distinct, so this doesn't need updating.
+        known = _startupModulesSet | self.previousModules.keys() | self.modules.keys()
         for origName in self.mf.any_missing_maybe()[0]:
-            if origName in startupModules:
-                continue
-            if origName in self.previousModules:
-                continue
-            if origName in self.modules:
+            if origName in known:
                 continue
 
             # This module is missing.  Let it be missing in the
@@ -1299,11 +1549,11 @@ class Freezer:
             self.modules[origName] = self.ModuleDef(origName, exclude = True,
                                                     implicit = True)
 
-            if origName in okMissing:
+            if origName in _okMissingSet:
                 # If it's listed in okMissing, don't even report it.
                 continue
 
-            prefix = origName.split('.')[0]
+            prefix = origName.partition('.')[0]
             if origName not in reportedMissing:
                 missing.append(origName)
                 reportedMissing[origName] = True
@@ -1312,6 +1562,12 @@ class Freezer:
             missing.sort()
             print("There are some missing modules: %r" % missing)
 
+        # Only hold on to the .pyc data of the modules that will be written.
+        keep = {mdef.moduleName for mdef in self.modules.values() if not mdef.exclude}
+        pycData = self.mf._pyc_data
+        for name in [name for name in pycData if name not in keep]:
+            del pycData[name]
+
     def __sortModuleKey(self, mdef):
         """ A sort key function to sort a list of mdef's into order,
         primarily to ensure that packages proceed their modules. """
@@ -1373,7 +1629,13 @@ class Freezer:
         remembered and will not be dumped again. """
 
         self.mf = None
-        self.previousModules = dict(self.modules)
+        self.previousModules = self.modules.copy()
+        self._modulePaths.clear()
+        self._moduleStars.clear()
+        self._moduleCachePath = None
+        self._marshalledCode.clear()
+        self._replacedCode.clear()
+        self.__multifileStreams = []
 
     def mangleName(self, moduleName):
         return 'M_' + moduleName.replace('.', '__').replace('-', '_')
@@ -1386,7 +1648,7 @@ class Freezer:
 
         moduleNames = []
 
-        for newName, mdef in list(self.modules.items()):
+        for newName, mdef in self.modules.items():
             if mdef.guess:
                 # Not really a module.
                 pass
@@ -1405,9 +1667,11 @@ class Freezer:
         of tuples: (moduleName, moduleDef)."""
 
         moduleDefs = []
+        getPrevious = self.previousModules.get
+        mfModules = self.mf.modules
 
-        for newName, mdef in list(self.modules.items()):
-            prev = self.previousModules.get(newName, None)
+        for newName, mdef in self.modules.items():
+            prev = getPrevious(newName)
             if not mdef.exclude:
                 # Include this module (even if a previous pass
                 # excluded it).  But don't bother if we exported it
@@ -1415,8 +1679,8 @@ class Freezer:
                 if prev and not prev.exclude:
                     # Previously exported.
                     pass
-                elif mdef.moduleName in self.mf.modules or \
-                     mdef.moduleName in startupModules or \
+                elif mdef.moduleName in mfModules or \
+                     mdef.moduleName in _startupModulesSet or \
                      mdef.filename:
                     moduleDefs.append((newName, mdef))
             elif mdef.forbid:
@@ -1432,7 +1696,7 @@ class Freezer:
         # actual filename we put in there is meaningful only for stack
         # traces, so we'll just use the module name.
         replace_paths = []
-        for moduleName, module in list(self.mf.modules.items()):
+        for moduleName, module in self.mf.modules.items():
             if module.__code__:
                 origPathname = module.__code__.co_filename
                 if origPathname:
@@ -1440,39 +1704,64 @@ class Freezer:
         self.mf.replace_paths = replace_paths
 
         # Now that we have built up the replacement mapping, go back
-        # through and actually replace the paths.
-        for moduleName, module in list(self.mf.modules.items()):
-            if module.__code__:
-                co = self.mf.replace_paths_in_code(module.__code__)
-                module.__code__ = co
-
-    def __addPyc(self, multifile, filename, code, compressionLevel):
+        # through and actually replace the paths.  Code that we have already
+        # been through is left alone, so that its marshalled form can be
+        # reused if we are writing more than one kind of output.
+        replacedCode = self._replacedCode
+        for moduleName, module in self.mf.modules.items():
+            code = module.__code__
+            if code and replacedCode.get(moduleName) is not code:
+                code = self.mf.replace_paths_in_code(code)
+                module.__code__ = code
+                replacedCode[moduleName] = code
+
+    def _marshalCode(self, code):
+        """ Returns marshal.dumps(code), reusing the earlier result if the
+        same code object has been marshalled before. """
+
+        entry = self._marshalledCode.get(id(code))
+        if entry is not None and entry[0] is code:
+            return entry[1]
+
+        data = marshal.dumps(code)
+        self._marshalledCode[id(code)] = (code, data)
+        return data
+
+    def __addPyc(self, multifile, filename, code, compressionLevel, data = None):
         if code:
-            data = importlib.util.MAGIC_NUMBER + b'\0\0\0\0\0\0\0\0'
-            data += marshal.dumps(code)
-
-            stream = StringStream(data)
+            if data is None:
+                data = self._marshalCode(code)
+            stream = StringStream(_PYC_HEADER + data)
             multifile.addSubfile(filename, stream, compressionLevel)
-            multifile.flush()
+            self.__multifileStreams.append(stream)
 
     def __addPythonDirs(self, multifile, moduleDirs, dirnames, compressionLevel):
         """ Adds all of the names on dirnames as a module directory. """
-        if not dirnames:
-            return
+        moduleName = ''
+        dirname = ''
+        for name in dirnames:
+            # Walk down from the outermost package, so that the names of
+            # the parent packages can be built up incrementally.
+            if moduleName:
+                moduleName += '.' + name
+                dirname += '/' + name
+            else:
+                moduleName = name
+                dirname = name
+
+            if moduleName in moduleDirs:
+                continue
 
-        str = '.'.join(dirnames)
-        if str not in moduleDirs:
             # Add an implicit __init__.py file (but only if there's
             # not already a legitimate __init__.py file).
-            moduleName = '.'.join(dirnames)
-            filename = '/'.join(dirnames) + '/__init__'
+            filename = dirname + '/__init__'
 
             if self.storePythonSource:
                 filename += '.py'
                 stream = StringStream(b'')
                 if multifile.findSubfile(filename) < 0:
                     multifile.addSubfile(filename, stream, 0)
-                    multifile.flush()
+                    self.__multifileStreams.append(stream)
             else:
                 if __debug__:
                     filename += '.pyc'
@@ -1482,8 +1771,7 @@ class Freezer:
                     code = compile('', moduleName, 'exec', optimize=self.optimize)
                     self.__addPyc(multifile, filename, code, compressionLevel)
 
-            moduleDirs[str] = True
-            self.__addPythonDirs(multifile, moduleDirs, dirnames[:-1], compressionLevel)
+            moduleDirs[moduleName] = True
 
     def __addPythonFile(self, multifile, moduleDirs, moduleName, mdef,
                         compressionLevel):
@@ -1509,11 +1797,17 @@ class Freezer:
             moduleDirs[moduleName] = True
 
             # Ensure we don't have an implicit filename from above.
-            multifile.removeSubfile(filename + '.py')
             if __debug__:
-                multifile.removeSubfile(filename + '.pyc')
+                implicitNames = (filename + '.py', filename + '.pyc')
             else:
-                multifile.removeSubfile(filename + '.pyo')
+                implicitNames = (filename + '.py', filename + '.pyo')
+
+            if any(multifile.findSubfile(name) >= 0 for name in implicitNames):
+                # The Multifile can't remove a subfile that hasn't been
+                # written yet, so flush what we have first.
+                multifile.flush()
+                for name in implicitNames:
+                    multifile.removeSubfile(name)
 
         # Attempt to add the original source file if we can.
         sourceFilename = None
@@ -1556,12 +1850,22 @@ class Freezer:
         else:
             # Read the code from the source file and compile it on-the-fly.
             if sourceFilename and sourceFilename.exists():
-                source = open(sourceFilename.toOsSpecific(), 'r').read()
-                if source and source[-1] != '\n':
-                    source = source + '\n'
+                # Read it as bytes, so that compile() can take the encoding
+                # declaration into account.
+                with open(sourceFilename.toOsSpecific(), 'rb') as file:
+                    source = file.read()
+                if source and not source.endswith(b'\n'):
+                    source += b'\n'
                 code = compile(source, str(sourceFilename), 'exec', optimize=self.optimize)
 
-        self.__addPyc(multifile, filename, code, compressionLevel)
+        # If the code was loaded from a .pyc file and hasn't been modified
+        # since, we can write the data it was loaded from as-is.
+        data = None
+        pycData = self.mf._pyc_data.pop(mdef.moduleName, None)
+        if pycData is not None and pycData[0] is code:
+            data = pycData[1]
+
+        self.__addPyc(multifile, filename, code, compressionLevel, data)
 
     def addToMultifile(self, multifile, compressionLevel = 0):
         """ After a call to done(), this stores all of the accumulated
@@ -1569,10 +1873,18 @@ class Freezer:
         extension modules are listed in self.extras.  """
 
         moduleDirs = {}
+
+        # The subfiles are only written when the Multifile is flushed, which
+        # we do once at the end, so the streams they are read from must be
+        # kept alive until then.  If something goes wrong before that, they
+        # are kept, since the Multifile may still be flushed when it is closed.
+        addPythonFile = self.__addPythonFile
         for moduleName, mdef in self.getModuleDefs():
             if not mdef.exclude:
-                self.__addPythonFile(multifile, moduleDirs, moduleName, mdef,
-                                     compressionLevel)
+                addPythonFile(multifile, moduleDirs, moduleName, mdef,
+                              compressionLevel)
+        multifile.flush()
+        self.__multifileStreams = []
 
     def writeMultifile(self, mfname):
         """ After a call to done(), this stores all of the accumulated
@@ -1598,7 +1910,9 @@ class Freezer:
 
         self.__replacePaths()
 
-        # Now generate the actual export table.
+        # Now generate the actual export table.  The module definitions are
+        # only rendered to C when they are written out, one at a time, since
+        # the rendered arrays are several times larger than the code itself.
         moduleDefs = []
         moduleList = []
 
@@ -1606,7 +1920,7 @@ class Freezer:
             origName = mdef.moduleName
             if mdef.forbid:
                 # Explicitly disallow importing this module.
-                moduleList.append(self.makeForbiddenModuleListEntry(moduleName))
+                moduleList.append((moduleName, None, None, None))
                 continue
 
             assert not mdef.exclude
@@ -1614,16 +1928,16 @@ class Freezer:
             module = self.mf.modules.get(origName, None)
             code = getattr(module, "__code__", None)
             if code:
-                code = marshal.dumps(code)
+                code = self._marshalCode(code)
 
                 mangledName = self.mangleName(moduleName)
-                moduleDefs.append(self.makeModuleDef(mangledName, code))
-                moduleList.append(self.makeModuleListEntry(mangledName, code, moduleName, module))
+                moduleDefs.append((mangledName, code))
+                moduleList.append((moduleName, mangledName, code, module))
                 continue
 
             #if moduleName in startupModules:
             #    # Forbid the loading of this startup module.
-            #    moduleList.append(self.makeForbiddenModuleListEntry(moduleName))
+            #    moduleList.append((moduleName, None, None, None))
             #    continue
 
             # This is a module with no associated Python code.  It is either
@@ -1638,11 +1952,11 @@ class Freezer:
             # trouble importing it as a builtin module.  Synthesize a frozen
             # module that loads it as builtin.
             if '.' in moduleName and self.linkExtensionModules:
-                code = compile('import sys;del sys.modules["%s"];from importlib._bootstrap import _builtin_from_name;_builtin_from_name("%s")' % (moduleName, moduleName), moduleName, 'exec', optimize=self.optimize)
+                code = _compileStub('import sys;del sys.modules["%s"];from importlib._bootstrap import _builtin_from_name;_builtin_from_name("%s")' % (_stubModuleName, _stubModuleName), moduleName, self.optimize)
                 code = marshal.dumps(code)
                 mangledName = self.mangleName(moduleName)
-                moduleDefs.append(self.makeModuleDef(mangledName, code))
-                moduleList.append(self.makeModuleListEntry(mangledName, code, moduleName, None))
+                moduleDefs.append((mangledName, code))
+                moduleList.append((moduleName, mangledName, code, None))
             elif '.' in moduleName:
                 # Nothing we can do about this case except warn the user they
                 # are in for some trouble.
@@ -1651,10 +1965,15 @@ class Freezer:
                       'passing either -l to link in extension modules or use '
                       '-x %s to exclude the entire package.' % (moduleName, moduleName.split('.')[0]))
 
-        text = programFile % {
-            'moduleDefs': '\n'.join(moduleDefs),
-            'moduleList': '\n'.join(moduleList),
-        }
+        # Everything before the module definitions is written out first, so
+        # it is kept separately from the rest of the text.
+        head, sep, text = programFile.partition('%(moduleDefs)s')
+        moduleListText = self.makeModuleList(moduleList)
+        head %= {'moduleList': moduleListText}
+        text %= {'moduleList': moduleListText}
+
+        # The rest is collected in a list and joined once at the end.
+        parts = [text]
 
         if self.linkExtensionModules and self.extras:
             # Should we link in extension modules?  If so, we write out a new
@@ -1663,64 +1982,68 @@ class Freezer:
             # built-in module table; on Windows, we can't do this, so we
             # instead use PyImport_ExtendInittab to add to it.
 
-            # Python 3 case.
-            text += '#if PY_MAJOR_VERSION >= 3\n'
-            for module, fn in self.extras:
-                if sys.platform != "win32" or fn:
-                    libName = module.split('.')[-1]
-                    initFunc = builtinInitFuncs.get(module, 'PyInit_' + libName)
-                    if initFunc:
-                        text += 'extern PyAPI_FUNC(PyObject) *%s(void);\n' % (initFunc)
-            text += '\n'
-
             if sys.platform == "win32":
-                text += 'static struct _inittab extensions[] = {\n'
+                tableDecl = 'static struct _inittab extensions[] = {\n'
             else:
-                text += 'struct _inittab _PyImport_Inittab[] = {\n'
-
+                tableDecl = 'struct _inittab _PyImport_Inittab[] = {\n'
+
+            # Gather the declarations and table entries for both Python 3
+            # and Python 2 in a single pass over the extension modules.
+            externs3 = []
+            entries3 = []
+            externs2 = []
+            entries2 = []
             for module, fn in self.extras:
                 if sys.platform != "win32" or fn:
-                    libName = module.split('.')[-1]
-                    initFunc = builtinInitFuncs.get(module, 'PyInit_' + libName) or 'NULL'
-                    text += '  {"%s", %s},\n' % (module, initFunc)
-            text += '  {0, 0},\n'
-            text += '};\n\n'
+                    libName = module.rpartition('.')[2]
+                    initFunc = builtinInitFuncs.get(module, 'PyInit_' + libName)
+                    if initFunc:
+                        externs3.append('extern PyAPI_FUNC(PyObject) *%s(void);\n' % (initFunc))
+                    entries3.append('  {"%s", %s},\n' % (module, initFunc or 'NULL'))
 
-            # Python 2 case.
-            text += '#else\n'
-            for module, fn in self.extras:
-                if sys.platform != "win32" or fn:
-                    libName = module.split('.')[-1]
                     initFunc = builtinInitFuncs.get(module, 'init' + libName)
                     if initFunc:
-                        text += 'extern PyAPI_FUNC(void) %s(void);\n' % (initFunc)
-            text += '\n'
+                        externs2.append('extern PyAPI_FUNC(void) %s(void);\n' % (initFunc))
+                    entries2.append('  {"%s", %s},\n' % (module, initFunc or 'NULL'))
 
-            if sys.platform == "win32":
-                text += 'static struct _inittab extensions[] = {\n'
-            else:
-                text += 'struct _inittab _PyImport_Inittab[] = {\n'
+            # Python 3 case.
+            parts.append('#if PY_MAJOR_VERSION >= 3\n')
+            parts += externs3
+            parts.append('\n')
+            parts.append(tableDecl)
+            parts += entries3
+            parts.append('  {0, 0},\n')
+            parts.append('};\n\n')
 
-            for module, fn in self.extras:
-                if sys.platform != "win32" or fn:
-                    libName = module.split('.')[-1]
-                    initFunc = builtinInitFuncs.get(module, 'init' + libName) or 'NULL'
-                    text += '  {"%s", %s},\n' % (module, initFunc)
-            text += '  {0, 0},\n'
-            text += '};\n'
-            text += '#endif\n\n'
+            # Python 2 case.
+            parts.append('#else\n')
+            parts += externs2
+            parts.append('\n')
+            parts.append(tableDecl)
+            parts += entries2
+            parts.append('  {0, 0},\n')
+            parts.append('};\n')
+            parts.append('#endif\n\n')
 
         elif sys.platform == "win32":
-            text += 'static struct _inittab extensions[] = {\n'
-            text += '  {0, 0},\n'
-            text += '};\n\n'
+            parts.append('static struct _inittab extensions[] = {\n')
+            parts.append('  {0, 0},\n')
+            parts.append('};\n\n')
 
-        text += initCode
+        parts.append(initCode)
+        text = ''.join(parts)
 
         if filename is not None:
-            file = open(filename, 'w')
-            file.write(text)
-            file.close()
+            # Write it in binary mode, so that the (large) module definitions
+            # don't need to go through newline translation.
+            with open(filename, 'wb') as file:
+                file.write(head.encode('utf-8'))
+                if sep:
+                    for i, (mangledName, code) in enumerate(moduleDefs):
+                        if i > 0:
+                            file.write(b'\n')
+                        file.write(self.makeModuleDef(mangledName, code).encode('utf-8'))
+                file.write(text.encode('utf-8'))
 
     def generateCode(self, basename, compileToExe = False):
         """ After a call to done(), this freezes all of the
@@ -1798,6 +2121,7 @@ class Freezer:
         cleanFiles = [filename, basename + self.objectExtension]
 
         extraLink = []
+        libCommands = []
         if self.linkExtensionModules:
             for mod, fn in self.extras:
                 if not fn:
@@ -1815,15 +2139,25 @@ class Freezer:
                     # No, so we have to generate a .lib file.  This is pretty
                     # easy given that we know the only symbol we need is a
                     # initmodule or PyInit_module function.
-                    modname = mod.split('.')[-1]
+                    modname = mod.rpartition('.')[2]
                     libfile = modname + '.lib'
                     symbolName = 'PyInit_' + modname
-                    os.system('lib /nologo /def /export:%s /name:%s.pyd /out:%s' % (symbolName, modname, libfile))
+                    libCommands.append('lib /nologo /def /export:%s /name:%s.pyd /out:%s' % (symbolName, modname, libfile))
                     extraLink.append(libfile)
                     cleanFiles += [libfile, modname + '.exp']
                 else:
                     extraLink.append(fn)
 
+        if libCommands:
+            # These don't depend on each other, so there's no need to wait
+            # for each one to finish before starting the next.
+            with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+                results = list(executor.map(_runCommand, libCommands))
+
+            for command, result in zip(libCommands, results):
+                if result != 0:
+                    raise Exception('failed to build import library: %s' % (command))
+
         try:
             compileFunc(filename, basename, extraLink=extraLink)
         finally:
@@ -1849,61 +2183,64 @@ class Freezer:
             modext = '.so'
 
         # First gather up the strings and code for all the module names, and
-        # put those in a string pool.
-        pool = b""
-        strings = set()
+        # put those in a string pool.  This is a bytearray, so that it can be
+        # extended in place rather than copied every time something is added.
+        pool = bytearray()
+        moduleDefs = self.getModuleDefs()
+        encodedNames = [moduleName.encode('ascii') for moduleName, mdef in moduleDefs]
+        encodedFields = {key: value.encode('utf-8')
+                         for key, value in fields.items() if value is not None}
 
-        for moduleName, mdef in self.getModuleDefs():
-            strings.add(moduleName.encode('ascii'))
-
-        for value in fields.values():
-            if value is not None:
-                strings.add(value.encode('utf-8'))
+        strings = set(encodedNames)
+        strings.update(encodedFields.values())
 
         # Sort by length descending, allowing reuse of partial strings.
-        strings = sorted(strings, key=lambda str:-len(str))
+        strings = sorted(strings, key=len, reverse=True)
         string_offsets = {}
 
         # Now add the strings to the pool, and collect the offsets relative to
-        # the beginning of the pool.
+        # the beginning of the pool.  Every suffix of a string that has been
+        # added is remembered, so that we can look up whether a string is
+        # already in there as part of a longer one, rather than searching.
+        suffix_offsets = {}
         for string in strings:
-            # First check whether it's already in there; it could be part of
-            # a longer string.
-            offset = pool.find(string + b'\0')
-            if offset < 0:
+            offset = suffix_offsets.get(string)
+            if offset is None:
                 offset = len(pool)
-                pool += string + b'\0'
+                pool.extend(string)
+                pool.append(0)
+                for i in range(len(string) + 1):
+                    suffix_offsets.setdefault(string[i:], offset + i)
             string_offsets[string] = offset
 
         # Now go through the modules and add them to the pool as well.  These
         # are not 0-terminated, but we later record their sizes and names in
         # a table after the blob header.
         moduleList = []
+        mfModules = self.mf.modules
 
-        for moduleName, mdef in self.getModuleDefs():
+        for encodedName, (moduleName, mdef) in zip(encodedNames, moduleDefs):
             origName = mdef.moduleName
             if mdef.forbid:
                 # Explicitly disallow importing this module.
-                moduleList.append((moduleName, 0, 0))
+                moduleList.append((encodedName, 0, 0))
                 continue
 
             # For whatever it's worth, align the code blocks.
-            if len(pool) & 3 != 0:
-                pad = (4 - (len(pool) & 3))
-                pool += b'\0' * pad
+            pool.extend(b'\0\0\0'[:-len(pool) & 3])
 
             assert not mdef.exclude
             # Allow importing this module.
-            module = self.mf.modules.get(origName, None)
+            module = mfModules.get(origName)
             code = getattr(module, "__code__", None)
             if code:
-                code = marshal.dumps(code)
+                code = self._marshalCode(code)
                 size = len(code)
                 if getattr(module, "__path__", None):
                     # Indicate package by negative size
                     size = -size
-                moduleList.append((moduleName, len(pool), size))
-                pool += code
+                moduleList.append((encodedName, len(pool), size))
+                pool.extend(code)
                 continue
 
             # This is a module with no associated Python code.  It is either
@@ -1926,17 +2263,17 @@ class Freezer:
 
                 code = \
                     f'import sys;' \
-                    f'del sys.modules["{moduleName}"];' \
+                    f'del sys.modules["{_stubModuleName}"];' \
                     f'import sys,os;' \
                     f'from importlib.machinery import ExtensionFileLoader,ModuleSpec;' \
                     f'from importlib._bootstrap import _load;' \
-                    f'path=os.path.join({direxpr}, "{moduleName}{modext}");' \
-                    f'_load(ModuleSpec(name="{moduleName}", loader=ExtensionFileLoader("{moduleName}", path), origin=path))'
+                    f'path=os.path.join({direxpr}, "{_stubModuleName}{modext}");' \
+                    f'_load(ModuleSpec(name="{_stubModuleName}", loader=ExtensionFileLoader("{_stubModuleName}", path), origin=path))'
 
-                code = compile(code, moduleName, 'exec', optimize=self.optimize)
+                code = _compileStub(code, moduleName, self.optimize)
                 code = marshal.dumps(code)
-                moduleList.append((moduleName, len(pool), len(code)))
-                pool += code
+                moduleList.append((encodedName, len(pool), len(code)))
+                pool.extend(code)
 
         # Determine the format of the header and module list entries depending
         # on the platform.
@@ -1999,7 +2336,7 @@ class Freezer:
             blob_offset = len(stub_data)
             if (blob_offset & (blob_align - 1)) != 0:
                 pad = (blob_align - (blob_offset & (blob_align - 1)))
-                stub_data += (b'\0' * pad)
+                stub_data.extend(bytes(pad))
                 blob_offset += pad
             assert (blob_offset % blob_align) == 0
             assert blob_offset == len(stub_data)
@@ -2007,29 +2344,30 @@ class Freezer:
         # Calculate the offsets for the variables.  These are pointers,
         # relative to the beginning of the blob.
         field_offsets = {}
-        for key, value in fields.items():
-            if value is not None:
-                encoded = value.encode('utf-8')
-                field_offsets[key] = pool_offset + string_offsets[encoded]
+        for key, encoded in encodedFields.items():
+            field_offsets[key] = pool_offset + string_offsets[encoded]
 
-        # OK, now go and write the blob.  This consists of the module table
+        # OK, now go and write the blob.  This begins with the module table
         # (there may be two in the case of a macOS universal (fat) binary).
-        blob = b""
+        # We already know how large the tables will be, so allocate them up
+        # front; the null entries at the end are already zeroed out this way.
+        tables = bytearray(pool_offset)
+        tables_ptr = 0
         append_offset = False
         for bitness in bitnesses:
-            entry_layout = entry_layouts[bitness]
+            entry_struct = struct.Struct(entry_layouts[bitness])
             header_layout = header_layouts[bitness]
 
-            table_offset = len(blob)
-            for moduleName, offset, size in moduleList:
-                encoded = moduleName.encode('ascii')
-                string_offset = pool_offset + string_offsets[encoded]
+            table_offset = tables_ptr
+            for encodedName, offset, size in moduleList:
+                string_offset = pool_offset + string_offsets[encodedName]
                 if size != 0:
                     offset += pool_offset
-                blob += struct.pack(entry_layout, string_offset, offset, size)
+                entry_struct.pack_into(tables, tables_ptr, string_offset, offset, size)
+                tables_ptr += entry_struct.size
 
             # A null entry marks the end of the module table.
-            blob += struct.pack(entry_layout, 0, 0, 0)
+            tables_ptr += entry_struct.size
 
             # These flags should match the enum in deploy-stub.c
             flags = 0
@@ -2072,29 +2410,29 @@ class Freezer:
                 # be appended to the end.
                 append_offset = True
 
-        # Add the string/code pool.
-        assert len(blob) == pool_offset
-        blob += pool
-        del pool
-
-        # Now pad out the blob to the calculated blob size.
-        if len(blob) < blob_size:
-            blob += b'\0' * (blob_size - len(blob))
-        assert len(blob) == blob_size
+        # The tables are followed by the string/code pool, and then padding up
+        # to the calculated blob size.  These are written out one after the
+        # other, rather than first being copied together into one buffer.
+        assert tables_ptr == pool_offset
+        blob_parts = [tables, pool, bytes(blob_size - pool_offset - len(pool))]
 
         if append_offset:
             # This is for legacy deploy-stub.
             warnings.warn("Could not find blob header. Is deploy-stub outdated?")
-            blob += struct.pack('<Q', blob_offset)
+            blob_parts.append(struct.pack('<Q', blob_offset))
 
         with open(target, 'wb') as f:
             if append_blob:
                 f.write(stub_data)
                 assert f.tell() == blob_offset
-                f.write(blob)
+                f.writelines(blob_parts)
             else:
-                stub_data[blob_offset:blob_offset + blob_size] = blob
-                f.write(stub_data)
+                # Write the blob over the placeholder that was reserved for it,
+                # without copying it into the stub data first.
+                with memoryview(stub_data) as view:
+                    f.write(view[:blob_offset])
+                    f.writelines(blob_parts)
+                    f.write(view[blob_offset + blob_size:])
 
         os.chmod(target, 0o755)
         return target
@@ -2105,10 +2443,10 @@ class Freezer:
 
         if data.startswith(b'MZ'):
             # A Windows PE file.
-            offset, = struct.unpack_from('<I', data, 0x3c)
+            offset, = _pe_offset_struct.unpack_from(data, 0x3c)
             assert data[offset:offset+4] == b'PE\0\0'
 
-            magic, = struct.unpack_from('<H', data, offset + 24)
+            magic, = _pe_magic_struct.unpack_from(data, offset + 24)
             assert magic in (0x010b, 0x020b)
             if magic == 0x020b:
                 return (64,)
@@ -2131,12 +2469,12 @@ class Freezer:
 
         elif data[:4] in (b'\xCA\xFE\xBA\xBE', b'\xBE\xBA\xFE\xCA'):
             # Universal binary with 32-bit offsets.
-            num_fat, = struct.unpack_from('>I', data, 4)
+            num_fat, = _fat_header_struct.unpack_from(data, 4)
             bitnesses = set()
             ptr = 8
             for i in range(num_fat):
                 cputype, cpusubtype, offset, size, align = \
-                    struct.unpack_from('>IIIII', data, ptr)
+                    _fat_arch_struct.unpack_from(data, ptr)
                 ptr += 20
 
                 if (cputype & 0x1000000) != 0:
@@ -2147,12 +2485,12 @@ class Freezer:
 
         elif data[:4] in (b'\xCA\xFE\xBA\xBF', b'\xBF\xBA\xFE\xCA'):
             # Universal binary with 64-bit offsets.
-            num_fat, = struct.unpack_from('>I', data, 4)
+            num_fat, = _fat_header_struct.unpack_from(data, 4)
             bitnesses = set()
             ptr = 8
             for i in range(num_fat):
                 cputype, cpusubtype, offset, size, align = \
-                    struct.unpack_from('>QQQQQ', data, ptr)
+                    _fat_arch_64_struct.unpack_from(data, ptr)
                 ptr += 40
 
                 if (cputype & 0x1000000) != 0:
@@ -2192,20 +2530,21 @@ class Freezer:
 
         elif data[:4] in (b'\xCA\xFE\xBA\xBE', b'\xBE\xBA\xFE\xCA'):
             # Universal binary with 32-bit offsets.
-            num_fat, = struct.unpack_from('>I', data, 4)
+            num_fat, = _fat_header_struct.unpack_from(data, 4)
             replaced = False
             ptr = 8
             for i in range(num_fat):
                 cputype, cpusubtype, offset, size, align = \
-                    struct.unpack_from('>IIIII', data, ptr)
+                    _fat_arch_struct.unpack_from(data, ptr)
                 ptr += 20
 
                 # Does this match the requested bitness?
                 if bitness is not None and ((cputype & 0x1000000) != 0) != (bitness == 64):
                     continue
 
-                macho_data = data[offset:offset+size]
-                off = self._find_symbol_macho(macho_data, symbol_name)
+                # Look at the slice in place, rather than copying it out.
+                with memoryview(data) as view:
+                    off = self._find_symbol_macho(view[offset:offset+size], symbol_name)
                 if off is not None:
                     off += offset
                     data[off:off+len(replacement)] = replacement
@@ -2215,20 +2554,21 @@ class Freezer:
 
         elif data[:4] in (b'\xCA\xFE\xBA\xBF', b'\xBF\xBA\xFE\xCA'):
             # Universal binary with 64-bit offsets.
-            num_fat, = struct.unpack_from('>I', data, 4)
+            num_fat, = _fat_header_struct.unpack_from(data, 4)
             replaced = False
             ptr = 8
             for i in range(num_fat):
                 cputype, cpusubtype, offset, size, align = \
-                    struct.unpack_from('>QQQQQ', data, ptr)
+                    _fat_arch_64_struct.unpack_from(data, ptr)
                 ptr += 40
 
                 # Does this match the requested bitness?
                 if bitness is not None and ((cputype & 0x1000000) != 0) != (bitness == 64):
                     continue
 
-                macho_data = data[offset:offset+size]
-                off = self._find_symbol_macho(macho_data, symbol_name)
+                # Look at the slice in place, rather than copying it out.
+                with memoryview(data) as view:
+                    off = self._find_symbol_macho(view[offset:offset+size], symbol_name)
                 if off is not None:
                     off += offset
                     data[off:off+len(replacement)] = replacement
@@ -2247,59 +2587,81 @@ class Freezer:
         # Make sure we read in the correct endianness and integer size
         endian = "<>"[ord(elf_data[5:6]) - 1]
         is_64bit = ord(elf_data[4:5]) - 1 # 0 = 32-bits, 1 = 64-bits
-        header_struct = endian + ("HHIIIIIHHHHHH", "HHIQQQIHHHHHH")[is_64bit]
-        section_struct = endian + ("4xI4xIIII8xI", "4xI8xQQQI12xQ")[is_64bit]
-        symbol_struct = endian + ("IIIBBH", "IBBHQQ")[is_64bit]
+        header_struct, section_struct, symbol_struct = _elf_structs[endian, is_64bit]
 
-        header_size = struct.calcsize(header_struct)
         type, machine, version, entry, phoff, shoff, flags, ehsize, phentsize, phnum, shentsize, shnum, shstrndx \
-          = struct.unpack_from(header_struct, elf_data, 16)
+          = header_struct.unpack_from(elf_data, 16)
+        sections = []
         section_offsets = []
         symbol_tables = []
         string_tables = {}
 
-        # Seek to the section header table and find the symbol tables.
+        # Seek to the section header table and find the symbol tables.  The
+        # headers are kept, so that we can look up the string tables after.
         ptr = shoff
         for i in range(shnum):
-            type, addr, offset, size, link, entsize = struct.unpack_from(section_struct, elf_data[ptr:ptr+shentsize])
+            section = section_struct.unpack_from(elf_data, ptr)
+            type, addr, offset, size, link, entsize = section
             ptr += shentsize
+            sections.append(section)
             section_offsets.append(offset - addr)
             if type == 0x0B and link != 0: # SHT_DYNSYM, links to string table
                 symbol_tables.append((offset, size, link, entsize))
                 string_tables[link] = None
 
         # Read the relevant string tables.
-        for idx in list(string_tables.keys()):
-            ptr = shoff + idx * shentsize
-            type, addr, offset, size, link, entsize = struct.unpack_from(section_struct, elf_data[ptr:ptr+shentsize])
+        for idx in string_tables:
+            type, addr, offset, size, link, entsize = sections[idx]
             if type == 3:
                 string_tables[idx] = elf_data[offset:offset+size]
 
+        # Rather than reading out the name of every symbol, find the offsets
+        # at which the name we are looking for occurs in each string table.
+        # A name may be the tail end of a longer one, so all are included.
+        needle = symbol_name + b'\0'
+        name_offsets = {}
+        for idx, strtab in string_tables.items():
+            offsets = set()
+            if strtab is not None:
+                i = strtab.find(needle)
+                while i >= 0:
+                    offsets.add(i)
+                    i = strtab.find(needle, i + 1)
+            name_offsets[idx] = offsets
+
         # Loop through to find the offset of the "blobinfo" symbol.
+        patches = set()
         for offset, size, link, entsize in symbol_tables:
+            offsets = name_offsets[link]
+            if not offsets:
+                continue
+
             entries = size // entsize
             for i in range(entries):
                 ptr = offset + i * entsize
-                fields = struct.unpack_from(symbol_struct, elf_data[ptr:ptr+entsize])
+                fields = symbol_struct.unpack_from(elf_data, ptr)
                 if is_64bit:
                     name, info, other, shndx, value, size = fields
                 else:
                     name, value, size, info, other, shndx = fields
 
-                if not name:
-                    continue
-
-                name = string_tables[link][name : string_tables[link].find(b'\0', name)]
-                if name == symbol_name:
+                if name in offsets:
                     if shndx == 0: # SHN_UNDEF
                         continue
                     elif shndx >= 0xff00 and shndx <= 0xffff:
                         assert False
                     else:
-                        # Got it.  Make the replacement.
-                        off = section_offsets[shndx] + value
-                        elf_data[off:off+len(replacement)] = replacement
-                        replaced = True
+                        # Got it.  Remember where to make the replacement.
+                        patches.add(section_offsets[shndx] + value)
+
+        # Now write the replacement at every location we found, in order.
+        # Since the lengths match, this happens in place, except for a symbol
+        # that is past the end of the file (eg. in .bss), which extends it.
+        if patches:
+            size = len(replacement)
+            for off in sorted(patches):
+                elf_data[off:off+size] = replacement
+            replaced = True
 
         return replaced
 
@@ -2311,84 +2673,107 @@ class Freezer:
         else:
             endian = '>'
 
+        header_struct, lc_header_struct, segment_struct, segment_64_struct, \
+            symtab_struct, nlist_struct, nlist_64_struct = _macho_structs[endian]
+
         cputype, cpusubtype, filetype, ncmds, sizeofcmds, flags = \
-            struct.unpack_from(endian + 'IIIIII', macho_data, 4)
+            header_struct.unpack_from(macho_data, 4)
 
         is_64bit = (cputype & 0x1000000) != 0
         segments = []
 
         cmd_ptr = 28
-        nlist_struct = endian + 'IBBHI'
         if is_64bit:
-            nlist_struct = endian + 'IBBHQ'
+            nlist_struct = nlist_64_struct
             cmd_ptr += 4
-        nlist_size = struct.calcsize(nlist_struct)
 
         for i in range(ncmds):
-            cmd, cmd_size = struct.unpack_from(endian + 'II', macho_data, cmd_ptr)
-            cmd_data = macho_data[cmd_ptr+8:cmd_ptr+cmd_size]
+            # The command data is read in place, rather than being sliced out.
+            cmd, cmd_size = lc_header_struct.unpack_from(macho_data, cmd_ptr)
+            cmd_data_ptr = cmd_ptr + 8
             cmd_ptr += cmd_size
 
             cmd &= ~0x80000000
 
             if cmd == 0x01: # LC_SEGMENT
                 segname, vmaddr, vmsize, fileoff, filesize, maxprot, initprot, nsects, flags = \
-                    struct.unpack_from(endian + '16sIIIIIIII', cmd_data)
+                    segment_struct.unpack_from(macho_data, cmd_data_ptr)
                 segments.append((vmaddr, vmsize, fileoff))
 
             elif cmd == 0x19: # LC_SEGMENT_64
                 segname, vmaddr, vmsize, fileoff, filesize, maxprot, initprot, nsects, flags = \
-                    struct.unpack_from(endian + '16sQQQQIIII', cmd_data)
+                    segment_64_struct.unpack_from(macho_data, cmd_data_ptr)
                 segments.append((vmaddr, vmsize, fileoff))
 
             elif cmd == 0x2: # LC_SYMTAB
                 symoff, nsyms, stroff, strsize = \
-                    struct.unpack_from(endian + 'IIII', cmd_data)
+                    symtab_struct.unpack_from(macho_data, cmd_data_ptr)
+
+                strings = bytes(macho_data[stroff:stroff+strsize])
+
+                # Rather than reading out the name of every symbol, find the
+                # offsets at which the name we are looking for occurs in the
+                # string table.  If there are none, no symbol can have it, so
+                # don't bother walking the symbol table.
+                needle = b'_' + symbol_name + b'\0'
+                offsets = set()
+                i = strings.find(needle)
+                while i >= 0:
+                    offsets.add(i)
+                    i = strings.find(needle, i + 1)
+                if not offsets:
+                    continue
 
-                strings = macho_data[stroff:stroff+strsize]
+                symbols = memoryview(macho_data)[symoff:symoff+nsyms*nlist_struct.size]
 
-                for j in range(nsyms):
-                    strx, type, sect, desc, value = struct.unpack_from(nlist_struct, macho_data, symoff)
-                    symoff += nlist_size
-                    name = strings[strx : strings.find(b'\0', strx)]
+                # Sort the segments by address, so that we can look up which
+                # one contains a given address with a binary search.
+                segments.sort()
+                segment_addrs = [segment[0] for segment in segments]
 
+                for strx, type, sect, desc, value in nlist_struct.iter_unpack(symbols):
                     # If the entry's type has any bits at 0xe0 set, it's a debug
                     # symbol, and will point us to the wrong place.
-                    if name == b'_' + symbol_name and type & 0xe0 == 0:
-                        # Find out in which segment this is.
-                        for vmaddr, vmsize, fileoff in segments:
+                    if strx in offsets and type & 0xe0 == 0:
+                        # Find out in which segment this is.  Segments don't
+                        # overlap, so it can only be the last one that starts
+                        # at or before this address.
+                        i = bisect.bisect_right(segment_addrs, value) - 1
+                        if i >= 0:
+                            vmaddr, vmsize, fileoff = segments[i]
                             # Is it defined in this segment?
                             rel = value - vmaddr
-                            if rel >= 0 and rel < vmsize:
+                            if rel < vmsize:
                                 # Yes, so return the symbol offset.
                                 return fileoff + rel
                         print("Could not find memory address for symbol %s" % (symbol_name))
 
     def _parse_macho_load_commands(self, macho_data):
         """Returns the list of load commands from macho_data."""
-        mach_header_64 = list(
-            struct.unpack_from(mach_header_64_layout, macho_data, 0))
-
-        num_load_commands = mach_header_64[4]
+        num_load_commands = _mach_header_64_struct.unpack_from(macho_data, 0)[4]
 
         load_commands = {}
 
-        curr_lc_offset = struct.calcsize(mach_header_64_layout)
+        curr_lc_offset = _mach_header_64_struct.size
         for i in range(num_load_commands):
-            lc = struct.unpack_from(lc_header_layout, macho_data, curr_lc_offset)
-            layout = lc_layouts.get(lc[0])
-            if layout:
-                # Make it a list since we want to mutate it.
-                lc = list(struct.unpack_from(layout, macho_data, curr_lc_offset))
-
-                if lc[0] == LC_SEGMENT_64:
-                    stripped_name = lc[2].rstrip(b'\0')
-                    if stripped_name in [b'__PANDA', b'__LINKEDIT']:
-                        load_commands[stripped_name] = (curr_lc_offset, lc)
+            cmd, cmd_size = _lc_header_struct.unpack_from(macho_data, curr_lc_offset)
+            lc_struct = _lc_structs.get(cmd)
+            if lc_struct is not None:
+                lc = lc_struct.unpack_from(macho_data, curr_lc_offset)
+
+                # Only the segments we need to modify are of interest.
+                if cmd == LC_SEGMENT_64:
+                    key = lc[2].rstrip(b'\0')
+                    if key not in lc_indices_to_slide:
+                        key = None
                 else:
-                    load_commands[lc[0]] = (curr_lc_offset, lc)
+                    key = cmd
+
+                if key is not None:
+                    # Make it a list since we want to mutate it.
+                    load_commands[key] = (curr_lc_offset, list(lc))
 
-            curr_lc_offset += lc[1]
+            curr_lc_offset += cmd_size
 
         return load_commands
 
@@ -2397,18 +2782,18 @@ class Freezer:
         all of the necessary structures to keep the binary valid. Returns the
         offset where the blob should be placed."""
 
-        for lc_key in load_commands.keys():
+        for lc_key, (lc_offset, lc) in load_commands.items():
             for index in lc_indices_to_slide[lc_key]:
-                load_commands[lc_key][1][index] += blob_size
+                lc[index] += blob_size
 
             if lc_key == b'__PANDA':
-                section_header_offset = load_commands[lc_key][0] + struct.calcsize(lc_layouts[LC_SEGMENT_64])
-                section_header = list(struct.unpack_from(section64_header_layout, macho_data, section_header_offset))
+                section_header_offset = lc_offset + _lc_structs[LC_SEGMENT_64].size
+                section_header = list(_section64_header_struct.unpack_from(macho_data, section_header_offset))
                 section_header[3] = blob_size
-                struct.pack_into(section64_header_layout, macho_data, section_header_offset, *section_header)
+                _section64_header_struct.pack_into(macho_data, section_header_offset, *section_header)
 
-            layout = LC_SEGMENT_64 if lc_key in [b'__PANDA', b'__LINKEDIT'] else lc_key
-            struct.pack_into(lc_layouts[layout], macho_data, load_commands[lc_key][0], *load_commands[lc_key][1])
+            # The segments are keyed by name rather than by command.
+            _lc_structs[lc[0]].pack_into(macho_data, lc_offset, *lc)
 
         blob_offset = load_commands[b'__PANDA'][1][5]
 
@@ -2418,7 +2803,8 @@ class Freezer:
         return blob_offset
 
     def makeModuleDef(self, mangledName, code):
-        lines = ',\n  '.join(','.join(map(str, code[i:i+16])) for i in range(0, len(code), 16))
+        dec = _DEC.__getitem__
+        lines = ',\n  '.join(','.join(map(dec, code[i:i+16])) for i in range(0, len(code), 16))
         return f'static unsigned char {mangledName}[] = {{\n  {lines}\n}};\n'
 
     def makeModuleListEntry(self, mangledName, code, moduleName, module):
@@ -2431,6 +2817,19 @@ class Freezer:
     def makeForbiddenModuleListEntry(self, moduleName):
         return '  {"%s", NULL, 0},' % (moduleName)
 
+    def makeModuleList(self, entries):
+        """ Returns the text of the module table for the given list of
+        (moduleName, mangledName, code, module) tuples, in which a forbidden
+        module has a mangledName of None.  Each line is generated by
+        makeModuleListEntry or makeForbiddenModuleListEntry. """
+
+        makeEntry = self.makeModuleListEntry
+        makeForbiddenEntry = self.makeForbiddenModuleListEntry
+        return '\n'.join([
+            makeEntry(mangledName, code, moduleName, module)
+            if mangledName is not None else makeForbiddenEntry(moduleName)
+            for moduleName, mangledName, code, module in entries])
+
     def __writingModule(self, moduleName):
         """ Returns true if we are outputting the named module in this
         pass, false if we have already output in a previous pass, or
@@ -2456,7 +2855,9 @@ class PandaModuleFinder(modulefinder.ModuleFinder):
         :param debug: an integer indicating the level of verbosity
         """
 
-        self.builtin_module_names = kw.pop('builtin_module_names', sys.builtin_module_names)
+        # This is checked for every module we try to find, before going to
+        # the filesystem, so make it a set.
+        self.builtin_module_names = frozenset(kw.pop('builtin_module_names', sys.builtin_module_names))
 
         self.suffixes = kw.pop('suffixes', (
             [(s, 'rb', _C_EXTENSION) for s in machinery.EXTENSION_SUFFIXES] +
@@ -2464,63 +2865,305 @@ class PandaModuleFinder(modulefinder.ModuleFinder):
             [(s, 'rb', _PY_COMPILED) for s in machinery.BYTECODE_SUFFIXES]
         ))
 
+        # Index the suffixes by their text, so that we can tell which one a
+        # filename ends with without trying each of them in turn.  If a suffix
+        # is listed more than once, the first entry wins, as it would when
+        # searching the list.
+        self._suffix_map = {}
+        for stuff in self.suffixes:
+            self._suffix_map.setdefault(stuff[0], stuff)
+
+        # Most names in a directory don't have any of our suffixes, which we
+        # can rule out in one go with this.
+        self._suffix_strs = tuple(self._suffix_map)
+
         self.optimize = kw.pop('optimize', -1)
 
         modulefinder.ModuleFinder.__init__(self, *args, **kw)
 
+        # This is checked for every module we try to find, so store it as a
+        # set rather than a list.
+        self.excludes = set(self.excludes)
+
+        # The opcode scanner used by scan_code, which is called for every code
+        # object we find.  This was renamed to scan_opcodes in Python 3.6.
+        self._scanner = getattr(self, 'scan_opcodes_25', None) or self.scan_opcodes
+
         # Make sure we don't open a .whl/.zip file more than once.
         self._zip_files = {}
+        self._zip_names = {}
+
+        # The contents of the directories we have looked at, see _scan_dir.
+        self._dir_entries = {}
+        self._dir_stems = {}
+
+        # Results of _dir_exists, which may have to look inside zip files.
+        self._dirs_exist = {}
+
+        # Maps directories to the file (if any) that they are inside of, see
+        # _find_enclosing_file.
+        self._enclosing_files = {}
+
+        # Whether there's a tkinter wheel on self.path, see _has_tkinter_wheel.
+        self._tkinter_wheel_path = None
+        self._tkinter_wheel = False
+
+        # Maps the names of modules loaded from a .pyc file to the code
+        # object and the marshalled data it was loaded from.
+        self._pyc_data = {}
+
+    def _get_zip_file(self, path):
+        """ Returns the ZipFile for the given file, or None if it is not a
+        zip file.  Either way, the answer is remembered, so that no archive
+        is opened (or checked for being one) more than once. """
+
+        try:
+            return self._zip_files[path]
+        except KeyError:
+            pass
+
+        if zipfile.is_zipfile(path):
+            zip = zipfile.ZipFile(path)
+        else:
+            zip = None
+        self._zip_files[path] = zip
+        return zip
+
+    def _get_zip_names(self, path):
+        """ Returns the sorted list of names in the zip file at the given path,
+        so that the names under a given directory can be looked up with a
+        binary search. """
+
+        try:
+            return self._zip_names[path]
+        except KeyError:
+            pass
+
+        names = sorted(self._get_zip_file(path).namelist())
+        self._zip_names[path] = names
+        return names
+
+    def _scan_dir(self, path):
+        """ Returns a dict mapping the names in the given directory to their
+        os.DirEntry objects, or None if there is no such directory.  Returns
+        False if it exists but could not be listed.  The listing is cached,
+        since the same directories are looked at over and over again while
+        searching for modules. """
+
+        try:
+            return self._dir_entries[path]
+        except KeyError:
+            pass
+
+        entries = self._list_dir_entries(path)
+        if entries is not False:
+            self._dir_entries[path] = entries
+        return entries
+
+    def _scan_dirs(self, paths):
+        """ Fills the directory cache for all of the given paths at once.
+        Listing a directory is mostly spent waiting on the filesystem, so
+        this is done on a few threads. """
+
+        paths = [path for path in set(paths) if path not in self._dir_entries]
+        if len(paths) > 1:
+            with ThreadPoolExecutor() as executor:
+                for path, entries in zip(paths, executor.map(self._list_dir_entries, paths)):
+                    if entries is not False:
+                        self._dir_entries[path] = entries
+        elif paths:
+            self._scan_dir(paths[0])
+
+    @staticmethod
+    def _list_dir_entries(path):
+        """ Lists the given directory for _scan_dir. """
+
+        try:
+            with os.scandir(path or os.curdir) as it:
+                return {entry.name: entry for entry in it}
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        except OSError:
+            # We may still be able to access what's in it, so don't cache this.
+            return False
+
+    def _module_names_in_dir(self, path):
+        """ Returns the set of names in the given directory that a module
+        could be found under: the names of subdirectories and files with the
+        recognized suffixes stripped off.  Returns None if it isn't a directory
+        that we can list. """
+
+        try:
+            return self._dir_stems[path]
+        except KeyError:
+            pass
+
+        entries = self._scan_dir(path)
+        if not isinstance(entries, dict):
+            return None
+
+        stems = set(entries)
+        suffix_strs = self._suffix_strs
+        for name in entries:
+            if not name.endswith(suffix_strs):
+                continue
+            stuff = self._match_suffix(name)
+            if stuff is not None:
+                stems.add(name[:-len(stuff[0])])
+
+        self._dir_stems[path] = stems
+        return stems
+
+    def _path_kind(self, path):
+        """ Returns 'file' or 'dir' if the given path exists on disk as a
+        regular file or a directory (following symlinks), 'other' if it is
+        something else, or None if it doesn't exist.  This is answered from
+        the listing of the parent directory, if possible. """
+
+        stripped = path.rstrip(os.path.sep + '/') or path
+        dir, name = os.path.split(stripped)
+        if name and name != os.curdir and name != os.pardir:
+            entries = self._scan_dir(dir)
+        else:
+            entries = False
+
+        if entries is None:
+            return None
+
+        if entries is False:
+            # No listing to go by; ask the OS.
+            if os.path.isfile(path):
+                return 'file'
+            elif os.path.isdir(path):
+                return 'dir'
+            elif os.path.exists(path):
+                return 'other'
+            return None
+
+        entry = entries.get(name)
+        if entry is None:
+            return None
+        elif entry.is_dir():
+            return 'dir'
+        elif stripped != path:
+            # With a trailing slash, the path can only refer to a directory.
+            return None
+        elif entry.is_file():
+            return 'file'
+        return 'other'
+
+    def _match_suffix(self, name):
+        """ Returns the (suffix, mode, type) tuple for the longest of our
+        suffixes that the given filename ends with, or None if it doesn't end
+        with any of them. """
+
+        # Every suffix starts with a dot, so we only need to try the tails of
+        # the name that do, starting with the longest one.
+        suffix_map = self._suffix_map
+        i = name.find('.')
+        while i >= 0:
+            stuff = suffix_map.get(name[i:])
+            if stuff is not None:
+                return stuff
+            i = name.find('.', i + 1)
+
+        return None
+
+    def _has_tkinter_wheel(self):
+        """ Returns True if there is a tkinter wheel on the search path.  This
+        is only checked again if the search path has changed since. """
+
+        path = self.path
+        if path != self._tkinter_wheel_path:
+            self._tkinter_wheel_path = list(path)
+            self._tkinter_wheel = any(entry.endswith(".whl") and os.path.basename(entry).startswith("tkinter-") for entry in path)
+        return self._tkinter_wheel
+
+    def _find_enclosing_file(self, dir):
+        """ Returns the nearest of the given directory and its parents that is
+        actually a file (such as a zip file), or None if there is none.  The
+        answer is remembered for every directory that had to be checked, so
+        that the same parents aren't walked again for the next path. """
+
+        cache = self._enclosing_files
+        visited = []
+        result = None
+        while True:
+            try:
+                result = cache[dir]
+                break
+            except KeyError:
+                pass
+
+            visited.append(dir)
+            if self._path_kind(dir) == 'file':
+                result = dir
+                break
+
+            # Look at the parent directory.
+            dir, dirname = os.path.split(dir)
+            if not dirname:
+                break
+
+        for dir in visited:
+            cache[dir] = result
+        return result
+
+    def _split_zip_path(self, path):
+        """ If the given path points inside a file, returns the path of that
+        file and the name of the path within it, using forward slashes as in a
+        zip file.  Returns None if the path isn't inside a file at all. """
+
+        dir, name = os.path.split(path)
+        if not name:
+            return None
+
+        root = self._find_enclosing_file(dir)
+        if root is None:
+            return None
+
+        fn = path[len(root):].lstrip(os.path.sep + '/')
+        return root, fn.replace(os.path.sep, '/')
 
     def _open_file(self, path, mode):
         """ Opens a module at the given path, which may contain a zip file.
         Returns None if the module could not be found. """
 
-        if os.path.isfile(path):
+        if self._path_kind(path) == 'file':
             if 'b' not in mode:
                 return io.open(path, mode, encoding='utf8')
             else:
                 return open(path, mode)
 
         # Is there a zip file along the path?
-        dir, dirname = os.path.split(path)
-        fn = dirname
-        while dirname:
-            if os.path.isfile(dir):
-                # Okay, this is actually a file.  Is it a zip file?
-                if dir in self._zip_files:
-                    # Yes, and we've previously opened this.
-                    zip = self._zip_files[dir]
-                elif zipfile.is_zipfile(dir):
-                    zip = zipfile.ZipFile(dir)
-                    self._zip_files[dir] = zip
-                else:
-                    # It's a different kind of file.  Stop looking.
-                    return None
-
-                try:
-                    zip_fn = fn.replace(os.path.sep, '/')
-                    if zip_fn.startswith('deploy_libs/_tkinter.'):
-                        # If we have a tkinter wheel on the path, ignore the
-                        # _tkinter extension in deploy-libs.
-                        if any(entry.endswith(".whl") and os.path.basename(entry).startswith("tkinter-") for entry in self.path):
-                            return None
-                    fp = zip.open(zip_fn, 'r')
-                except KeyError:
-                    return None
+        split = self._split_zip_path(path)
+        if split is None:
+            return None
 
-                if 'b' not in mode:
-                    return io.TextIOWrapper(fp, encoding='utf8')
-                return fp
+        root, zip_fn = split
+        zip = self._get_zip_file(root)
+        if zip is None:
+            # It's a different kind of file.
+            return None
 
-            # Look at the parent directory.
-            dir, dirname = os.path.split(dir)
-            fn = os.path.join(dirname, fn)
+        try:
+            if zip_fn.startswith('deploy_libs/_tkinter.'):
+                # If we have a tkinter wheel on the path, ignore the
+                # _tkinter extension in deploy-libs.
+                if self._has_tkinter_wheel():
+                    return None
+            fp = zip.open(zip_fn, 'r')
+        except KeyError:
+            return None
 
-        return None
+        if 'b' not in mode:
+            return io.TextIOWrapper(fp, encoding='utf8')
+        return fp
 
     def _file_exists(self, path):
-        if os.path.exists(path):
-            return os.path.isfile(path)
+        kind = self._path_kind(path)
+        if kind is not None:
+            return kind == 'file'
 
         fh = self._open_file(path, 'rb')
         if fh:
@@ -2533,76 +3176,71 @@ class PandaModuleFinder(modulefinder.ModuleFinder):
         """Returns True if the given directory exists, either on disk or inside
         a wheel."""
 
-        if os.path.isdir(path):
-            return True
+        try:
+            return self._dirs_exist[path]
+        except KeyError:
+            pass
 
-        # Is there a zip file along the path?
-        dir, dirname = os.path.split(path.rstrip(os.path.sep + '/'))
-        fn = dirname
-        while dirname:
-            if os.path.isfile(dir):
-                # Okay, this is actually a file.  Is it a zip file?
-                if dir in self._zip_files:
-                    # Yes, and we've previously opened this.
-                    zip = self._zip_files[dir]
-                elif zipfile.is_zipfile(dir):
-                    zip = zipfile.ZipFile(dir)
-                    self._zip_files[dir] = zip
-                else:
-                    # It's a different kind of file.  Stop looking.
-                    return None
+        result = self._find_dir(path)
+        self._dirs_exist[path] = result
+        return result
 
-                # (Most) zip files do not store directories; check instead for a
-                # file whose path starts with this directory name.
-                prefix = fn.replace(os.path.sep, '/') + '/'
-                for name in zip.namelist():
-                    if name.startswith(prefix):
-                        return True
+    def _find_dir(self, path):
+        """Implements _dir_exists, without the caching."""
 
-                return False
+        if self._path_kind(path) == 'dir':
+            return True
 
-            # Look at the parent directory.
-            dir, dirname = os.path.split(dir)
-            fn = os.path.join(dirname, fn)
+        # Is there a zip file along the path?
+        split = self._split_zip_path(path.rstrip(os.path.sep + '/'))
+        if split is None:
+            return False
 
-        return False
+        root, fn = split
+        if self._get_zip_file(root) is None:
+            # It's a different kind of file.
+            return None
+
+        # (Most) zip files do not store directories; check instead for a
+        # file whose path starts with this directory name.  If there is one,
+        # it sorts right after the prefix itself.
+        prefix = fn + '/'
+        names = self._get_zip_names(root)
+        i = bisect.bisect_left(names, prefix)
+        return i < len(names) and names[i].startswith(prefix)
 
     def _listdir(self, path):
         """Lists files in the given directory if it exists."""
 
-        if os.path.isdir(path):
-            return os.listdir(path)
+        if self._path_kind(path) == 'dir':
+            entries = self._scan_dir(path)
+            if entries is False:
+                return os.listdir(path)
+            return list(entries or ())
 
         # Is there a zip file along the path?
-        dir, dirname = os.path.split(path.rstrip(os.path.sep + '/'))
-        fn = dirname
-        while dirname:
-            if os.path.isfile(dir):
-                # Okay, this is actually a file.  Is it a zip file?
-                if dir in self._zip_files:
-                    # Yes, and we've previously opened this.
-                    zip = self._zip_files[dir]
-                elif zipfile.is_zipfile(dir):
-                    zip = zipfile.ZipFile(dir)
-                    self._zip_files[dir] = zip
-                else:
-                    # It's not a directory or zip file.
-                    return []
-
-                # List files whose path start with our directory name.
-                prefix = fn.replace(os.path.sep, '/') + '/'
-                result = []
-                for name in zip.namelist():
-                    if name.startswith(prefix) and '/' not in name[len(prefix):]:
-                        result.append(name[len(prefix):])
-
-                return result
-
-            # Look at the parent directory.
-            dir, dirname = os.path.split(dir)
-            fn = os.path.join(dirname, fn)
-
-        return []
+        split = self._split_zip_path(path.rstrip(os.path.sep + '/'))
+        if split is None:
+            return []
+
+        root, fn = split
+        if self._get_zip_file(root) is None:
+            # It's not a directory or zip file.
+            return []
+
+        # List files whose path start with our directory name.  These are all
+        # next to each other in the sorted list of names.
+        prefix = fn + '/'
+        names = self._get_zip_names(root)
+        result = []
+        for i in range(bisect.bisect_left(names, prefix), len(names)):
+            name = names[i]
+            if not name.startswith(prefix):
+                break
+            if '/' not in name[len(prefix):]:
+                result.append(name[len(prefix):])
+
+        return result
 
     def load_module(self, fqname, fp, pathname, file_info):
         """Copied from ModuleFinder.load_module with fixes to handle sending bytes
@@ -2622,40 +3260,63 @@ class PandaModuleFinder(modulefinder.ModuleFinder):
             m.__path__ = pathname
             return m
 
-        if type == _PY_SOURCE:
-            if fqname in overrideModules:
-                # This module has a custom override.
-                code = overrideModules[fqname]
-            else:
-                code = fp.read()
+        if type == _PY_SOURCE and fqname in overrideModules:
+            # This module has a custom override.
+            co = _compileOverride(overrideModules[fqname], pathname, self.optimize)
+        elif type == _PY_SOURCE:
+            code = fp.read()
 
             # Strip out delvewheel patch (see GitHub issue #1492)
             if isinstance(code, bytes):
                 # Don't look for \n at the end, it may also be \r\n
                 start_marker = b'# start delvewheel patch'
                 end_marker = b'# end delvewheel patch'
+                newline = b'\n'
             else:
                 start_marker = '# start delvewheel patch'
                 end_marker = '# end delvewheel patch'
+                newline = '\n'
 
+            # Collect the pieces in between the patches, and join them (along
+            # with a terminating newline) in one go at the end.  Most files
+            # don't have a patch, and those are compiled as they were read,
+            # since compile() doesn't need the newline.
             start = code.find(start_marker)
-            while start >= 0:
-                end = code.find(end_marker, start) + len(end_marker)
-                code = code[:start] + code[end:]
-                start = code.find(start_marker)
+            if start >= 0:
+                pieces = []
+                pos = 0
+                while start >= 0:
+                    pieces.append(code[pos:start])
+                    end = code.find(end_marker, start)
+                    if end < 0:
+                        # Unterminated patch; drop the rest of the file.
+                        pos = len(code)
+                        break
+                    pos = end + len(end_marker)
+                    start = code.find(start_marker, pos)
+
+                pieces.append(code[pos:])
+                pieces.append(newline)
+                code = newline[:0].join(pieces)
 
-            code += b'\n' if isinstance(code, bytes) else '\n'
             co = compile(code, pathname, 'exec', optimize=self.optimize)
         elif type == _PY_COMPILED:
             if sys.version_info >= (3, 7):
-                try:
-                    data = fp.read()
-                    importlib._bootstrap_external._classify_pyc(data, fqname, {})
-                except ImportError as exc:
-                    self.msgout(2, "raise ImportError: " + str(exc), pathname)
-                    raise
+                data = fp.read()
 
-                co = marshal.loads(memoryview(data)[16:])
+                # In the common case of a valid header, it's quicker to check
+                # the magic number and flags ourselves.  Otherwise, let
+                # importlib figure out what is wrong with it.
+                if len(data) < 16 or data[:4] != importlib.util.MAGIC_NUMBER or \
+                   int.from_bytes(data[4:8], 'little') & ~0b11:
+                    try:
+                        importlib._bootstrap_external._classify_pyc(data, fqname, {})
+                    except ImportError as exc:
+                        self.msgout(2, "raise ImportError: " + str(exc), pathname)
+                        raise
+
+                marshal_data = memoryview(data)[16:]
+                co = marshal.loads(marshal_data)
             else:
                 try:
                     marshal_data = importlib._bootstrap_external._validate_bytecode_header(fp.read())
@@ -2664,6 +3325,10 @@ class PandaModuleFinder(modulefinder.ModuleFinder):
                     raise
 
                 co = marshal.loads(marshal_data)
+
+            # Keep the data around, so that it doesn't need to be marshalled
+            # again if the code is written to a Multifile unmodified.
+            self._pyc_data[fqname] = (co, marshal_data)
         else:
             co = None
 
@@ -2685,8 +3350,9 @@ class PandaModuleFinder(modulefinder.ModuleFinder):
             self._add_badmodule(name, caller)
             return
 
-        if level <= 0 and caller and caller.__name__ in ignoreImports:
-            if name in ignoreImports[caller.__name__]:
+        if level <= 0 and caller:
+            ignored = ignoreImports.get(caller.__name__)
+            if ignored and name in ignored:
                 return
 
         try:
@@ -2711,14 +3377,7 @@ class PandaModuleFinder(modulefinder.ModuleFinder):
                         self._add_badmodule(fullname, caller)
 
     def scan_code(self, co, m):
-        code = co.co_code
-        # This was renamed to scan_opcodes in Python 3.6
-        if hasattr(self, 'scan_opcodes_25'):
-            scanner = self.scan_opcodes_25
-        else:
-            scanner = self.scan_opcodes
-
-        for what, args in scanner(co):
+        for what, args in self._scanner(co):
             if what == "store":
                 name, = args
                 m.globalnames[name] = 1
@@ -2778,8 +3437,9 @@ class PandaModuleFinder(modulefinder.ModuleFinder):
                 # We don't expect anything else from the generator.
                 raise RuntimeError(what)
 
+        code_type = type(co)
         for c in co.co_consts:
-            if isinstance(c, type(co)):
+            if isinstance(c, code_type):
                 self.scan_code(c, m)
 
     def find_module(self, name, path=None, parent=None):
@@ -2829,7 +3489,7 @@ class PandaModuleFinder(modulefinder.ModuleFinder):
 
         elif parent is not None and parent.__name__ in ('setuptools.extern', 'pkg_resources.extern'):
             # Look for vendored versions of these libraries.
-            root = self.modules[parent.__name__.split('.', 1)[0]]
+            root = self.modules[parent.__name__.partition('.')[0]]
             try:
                 fp, fn, stuff = self.find_module('_vendor', root.__path__, parent=root)
                 vendor = self.load_module(root.__name__ + '._vendor', fp, fn, stuff)
@@ -2840,25 +3500,51 @@ class PandaModuleFinder(modulefinder.ModuleFinder):
         # Look for the module on the search path.
         ns_dirs = []
 
+        modname = name.rpartition('.')[2]
         for dir_path in path:
-            basename = os.path.join(dir_path, name.split('.')[-1])
+            # If this is a directory on disk, we can tell right away whether
+            # there's anything in it by this name.
+            names = self._module_names_in_dir(dir_path)
+            if names is not None:
+                if modname not in names:
+                    continue
+                entries = self._scan_dir(dir_path)
+            else:
+                entries = None
+
+            basename = os.path.join(dir_path, modname)
 
-            # Look for recognized extensions.
+            # Look for recognized extensions.  If we have the listing of the
+            # directory, only try to open the files that are in it.
             for stuff in self.suffixes:
                 suffix, mode, _ = stuff
+                if entries is not None:
+                    entry = entries.get(modname + suffix)
+                    if entry is None or not entry.is_file():
+                        continue
+
                 fp = self._open_file(basename + suffix, mode)
                 if fp:
                     return (fp, basename + suffix, stuff)
 
+            # Otherwise, it can only be a package if there's a directory by
+            # this name, so check that first.
+            if entries is not None:
+                entry = entries.get(modname)
+                if entry is None or not entry.is_dir():
+                    continue
+            elif not self._dir_exists(basename):
+                continue
+
             # Consider a package, i.e. a directory containing __init__.py.
+            # There's no need to open the file to find that out.
             for suffix, mode, _ in self.suffixes:
                 init = os.path.join(basename, '__init__' + suffix)
-                if self._open_file(init, mode):
+                if self._file_exists(init):
                     return (None, basename, ('', '', _PKG_DIRECTORY))
 
-            # This may be a namespace package.
-            if self._dir_exists(basename):
-                ns_dirs.append(basename)
+            # This is a namespace package.
+            ns_dirs.append(basename)
 
         # It wasn't found through the normal channels.  Maybe it's one of
         # ours, or maybe it's frozen?
@@ -2886,13 +3572,14 @@ class PandaModuleFinder(modulefinder.ModuleFinder):
             except OSError:
                 self.msg(2, "can't list directory", dir)
                 continue
+            suffix_strs = self._suffix_strs
             for name in sorted(names):
-                mod = None
-                for suff in self.suffixes:
-                    n = len(suff)
-                    if name[-n:] == suff:
-                        mod = name[:-n]
-                        break
+                if not name.endswith(suffix_strs):
+                    continue
+                stuff = self._match_suffix(name)
+                if stuff is None:
+                    continue
+                mod = name[:-len(stuff[0])]
                 if mod and mod != "__init__":
                     modules[mod] = mod
         return modules.keys()
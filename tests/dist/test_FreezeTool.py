@@ -1,4 +1,4 @@
-from direct.dist.FreezeTool import Freezer, PandaModuleFinder
+from direct.dist.FreezeTool import Freezer, PandaModuleFinder, CompilationEnvironment
 import pytest
 import os
 import sys
@@ -113,3 +113,98 @@ def test_Freezer_generateRuntimeFromStub(tmp_path, use_console):
 
     output = subprocess.check_output(target, env=env)
     assert output.replace(b'\r\n', b'\n') == b'Module imported\nHello world\n'
+
+
+def test_Freezer_hiddenImports_not_shared():
+    from direct.dist.FreezeTool import defaultHiddenImports
+
+    orig = list(defaultHiddenImports['plyer'])
+    freezer1 = Freezer(platform='linux_x86_64')
+    freezer2 = Freezer(platform='linux_x86_64')
+
+    assert defaultHiddenImports['plyer'] == orig
+    assert freezer1.hiddenImports['plyer'] == orig + ['plyer.platforms.linux.*']
+    assert freezer2.hiddenImports['plyer'] == orig + ['plyer.platforms.linux.*']
+
+
+def test_Freezer_packagePath_not_duplicated():
+    import modulefinder
+
+    Freezer()
+    before = {name: list(paths) for name, paths in modulefinder.packagePathMap.items()}
+    Freezer()
+    after = {name: list(paths) for name, paths in modulefinder.packagePathMap.items()}
+
+    assert before == after
+    for paths in after.values():
+        assert len(paths) == len(set(paths))
+
+
+def test_Freezer_replace_symbol_elf_nobits():
+    import struct
+
+    # A minimal 64-bit ELF file with a dynamic symbol in a NOBITS section
+    # (like .bss), which therefore lies at the end of the file.
+    dynstr = b'\0blobinfo\0'.ljust(16, b'\0')
+    dynsym = bytes(24) + struct.pack('<IBBHQQ', 1, 0x11, 0, 3, 0x1000, 16)
+    shoff = 64 + len(dynstr) + len(dynsym)
+    end = shoff + 4 * 64
+    sections = [
+        bytes(64),
+        struct.pack('<IIQQQQIIQQ', 0, 0x0B, 0, 0, 80, len(dynsym), 2, 1, 8, 24),
+        struct.pack('<IIQQQQIIQQ', 0, 3, 0, 0, 64, len(dynstr), 0, 0, 1, 0),
+        struct.pack('<IIQQQQIIQQ', 0, 8, 0, 0x1000, end, 16, 0, 0, 8, 0),
+    ]
+    elf_data = bytearray(b'\x7fELF\x02\x01\x01'.ljust(16, b'\0'))
+    elf_data += struct.pack('<HHIQQQIHHHHHH', 3, 62, 1, 0, 0, shoff, 0, 64, 0, 0, 64, 4, 0)
+    elf_data += dynstr + dynsym + b''.join(sections)
+    assert len(elf_data) == end
+
+    replacement = bytes(range(16))
+    freezer = Freezer()
+    assert freezer._replace_symbol_elf(elf_data, b'blobinfo', replacement)
+    assert elf_data[end:] == replacement
+    assert not freezer._replace_symbol_elf(elf_data, b'nothere', replacement)
+
+
+@pytest.mark.parametrize("platform", ("linux_x86_64", "macosx_10_9_x86_64"))
+def test_CompilationEnvironment_compileExe(monkeypatch, platform):
+    commands = []
+    def run(args, *posargs, **kwargs):
+        if not isinstance(args, str):
+            args = ' '.join(args)
+        commands.append(args)
+        return subprocess.CompletedProcess(args, 0)
+    monkeypatch.setattr(subprocess, "run", run)
+
+    cenv = CompilationEnvironment(platform)
+    cenv.compileExe('test.c', 'test', extraLink=['extra.so'])
+
+    assert len(commands) == 2
+    assert 'test.c' in commands[0]
+    assert 'test.o' in commands[0]
+    assert commands[1].endswith(' extra.so')
+
+
+def test_CompilationEnvironment_compileExe_missing_compiler(tmp_path):
+    cenv = CompilationEnvironment("linux_x86_64")
+    cenv.compileObjExe = str(tmp_path / "nonexistent-cc") + " -c %(filename)s"
+
+    with pytest.raises(Exception, match="failed to compile"):
+        cenv.compileExe('test.c', 'test')
+
+
+def test_PandaModuleFinder_find_all_submodules(tmp_path):
+    from importlib import machinery
+
+    package = tmp_path / "package"
+    package.mkdir()
+    (package / "__init__.py").write_text("")
+    (package / "module1.py").write_text("")
+    (package / ("module2" + machinery.EXTENSION_SUFFIXES[0])).write_text("")
+    (package / "README.txt").write_text("")
+
+    finder = PandaModuleFinder(path=[str(tmp_path)])
+    finder.import_hook("package")
+    submodules = finder.find_all_submodules(finder.modules["package"])
+    assert sorted(submodules) == ["module1", "module2"]